@@ -0,0 +1,222 @@
+# Copyright (c) 2013 Yubico AB
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#    1. Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    2. Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Benchmarks for yubicommon.ctypes library resolution and call dispatch.
+
+Runs offline against libc/libm, and a small shared object compiled on the
+fly when a C compiler is available. Usage:
+
+    $ python bench/ctypes_bench.py [--json] [--quick]
+
+All times are in seconds.
+"""
+
+from __future__ import absolute_import, print_function
+
+import ctypes
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from yubicommon.ctypes import CLibrary, EAGER, LAZY, registry  # noqa: E402
+from yubicommon.ctypes import libloader  # noqa: E402
+
+
+TEST_SOURCE = """
+int bench_add(int a, int b) { return a + b; }
+"""
+
+COLD_LOAD = """
+import sys, time
+sys.path.insert(0, %r)
+from yubicommon.ctypes import load_library
+start = time.time()
+load_library(%r)
+print(time.time() - start)
+"""
+
+
+def build_test_library(tmpdir):
+    """Compile the test shared object, returns its path or None."""
+    src = os.path.join(tmpdir, 'bench.c')
+    lib = os.path.join(tmpdir, 'libycbench.so')
+    with open(src, 'w') as f:
+        f.write(TEST_SOURCE)
+    cc = os.environ.get('CC', 'cc')
+    try:
+        subprocess.check_call([cc, '-shared', '-fPIC', '-O2', '-o', lib, src],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return lib
+
+
+def best(fn, number, repeat=5):
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+
+
+def bench_load(libname, runs):
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                        os.pardir))
+    cold = []
+    for _ in range(runs):
+        out = subprocess.check_output(
+            [sys.executable, '-c', COLD_LOAD % (root, libname)])
+        cold.append(float(out.decode().strip()))
+
+    registry.invalidate()
+    uncached = best(lambda: libloader.loader.load_library(libname), 20)
+    libloader.load_library(libname)
+    warm = best(lambda: libloader.load_library(libname), 10000)
+    return {
+        'cold_process': min(cold),
+        'uncached': uncached,
+        'warm': warm
+    }
+
+
+def bench_ld_so_cache(tmpdir, counts, files_per_dir=20):
+    loader = libloader.PosixLibraryLoader()
+    results = []
+    cache_file = os.path.join(tmpdir, 'ld_so_cache.json')
+    old_env = os.environ.get('YUBICOMMON_LD_CACHE')
+    try:
+        for count in counts:
+            dirs = []
+            for i in range(count):
+                d = os.path.join(tmpdir, 'dirs', 'd%d' % i)
+                if not os.path.isdir(d):
+                    os.makedirs(d)
+                    for j in range(files_per_dir):
+                        open(os.path.join(d, 'libx%d_%d.so.1' % (i, j)),
+                             'w').close()
+                dirs.append(d)
+            loader.other_dirs = dirs
+
+            os.environ['YUBICOMMON_LD_CACHE'] = ''
+            uncached = best(loader._create_ld_so_cache, 1, 3)
+            os.environ['YUBICOMMON_LD_CACHE'] = cache_file
+            if os.path.exists(cache_file):
+                os.remove(cache_file)
+            loader._create_ld_so_cache()  # Populate the persistent cache.
+            persisted = best(loader._create_ld_so_cache, 1, 3)
+            results.append({
+                'directories': count,
+                'uncached': uncached,
+                'persistent': persisted,
+                'getpaths': best(lambda: list(loader.getpaths('x0_0', [])),
+                                 5, 3)
+            })
+    finally:
+        if old_env is None:
+            os.environ.pop('YUBICOMMON_LD_CACHE', None)
+        else:
+            os.environ['YUBICOMMON_LD_CACHE'] = old_env
+    return results
+
+
+def bench_dispatch(libname, func_name, argtypes, restype, args, number):
+    Lib = type('Lib', (CLibrary,), {func_name: (argtypes, restype)})
+
+    class EagerLib(Lib):
+        _binding = EAGER
+
+    class LazyLib(Lib):
+        _binding = LAZY
+
+    raw = registry.load_library(libname)[func_name]
+    raw.argtypes = argtypes
+    raw.restype = restype
+
+    results = {'raw': best(lambda: raw(*args), number)}
+    for name, cls in (('dynamic', Lib), ('eager', EagerLib),
+                      ('lazy', LazyLib)):
+        lib = cls(libname)
+        results[name] = best(lambda: getattr(lib, func_name)(*args), number)
+        results[name + '_map'] = best(
+            lambda: lib.map(func_name, [args] * 1000), max(1, number // 1000)
+        ) / 1000
+    for name in ('dynamic', 'eager', 'lazy'):
+        results[name + '_overhead'] = results[name] - results['raw']
+    return results
+
+
+def main():
+    as_json = '--json' in sys.argv
+    quick = '--quick' in sys.argv
+    number = 2000 if quick else 50000
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        results = {
+            'python': sys.version.split()[0],
+            'platform': sys.platform,
+            'load': {'m': bench_load('m', 3 if quick else 10)},
+            'dispatch': {
+                'libm:fabs': bench_dispatch(
+                    'm', 'fabs', [ctypes.c_double], ctypes.c_double, (-1.0,),
+                    number)
+            }
+        }
+        if sys.platform not in ('darwin', 'win32', 'cygwin'):
+            results['ld_so_cache'] = bench_ld_so_cache(
+                tmpdir, [10, 50] if quick else [10, 50, 100, 200])
+
+        test_lib = build_test_library(tmpdir)
+        if test_lib:
+            results['load']['test'] = bench_load(test_lib, 3 if quick else 10)
+            results['dispatch']['test:bench_add'] = bench_dispatch(
+                test_lib, 'bench_add', [ctypes.c_int, ctypes.c_int],
+                ctypes.c_int, (1, 2), number)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    if as_json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        print('Python %s on %s' % (results['python'], results['platform']))
+        for lib, load in sorted(results['load'].items()):
+            print('load %-6s cold process %.6f uncached %.6f warm %.9f' % (
+                lib, load['cold_process'], load['uncached'], load['warm']))
+        for row in results.get('ld_so_cache', []):
+            print('ld.so cache %4d dirs: uncached %.6f persistent %.6f '
+                  'getpaths %.6f' % (row['directories'], row['uncached'],
+                                     row['persistent'], row['getpaths']))
+        for func, times in sorted(results['dispatch'].items()):
+            print('call %s:' % func)
+            for name, value in sorted(times.items()):
+                print('  %-20s %.9f' % (name, value))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+# Copyright (c) 2014 Yubico AB
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Additional permission under GNU GPL version 3 section 7
+#
+# If you modify this program, or any covered work, by linking or
+# combining it with the OpenSSL project's OpenSSL library (or a
+# modified version of that library), containing parts covered by the
+# terms of the OpenSSL or SSLeay licenses, We grant you additional
+# permission to convey the resulting work. Corresponding Source for a
+# non-source form of such a combination shall include the source code
+# for the parts of OpenSSL used as well as that of the covered work.
+
+"""Benchmarks and stress tests for yubicommon.qt.worker.Worker.
+
+Runs headless using the offscreen Qt platform. Usage:
+
+    $ python bench/worker_bench.py [--json] [--jobs N]
+
+Besides raw throughput, N jobs are posted through each of post_bg, post and
+post_fg, measuring the latency from posting a job until its callback runs
+on the GUI thread, the maximum queue depth and memory growth. The exit
+status is non-zero if _Event or _SignalConnector instances, or progress
+dialogs, are leaked.
+"""
+
+from __future__ import absolute_import, print_function
+
+import gc
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PySide import QtCore, QtGui  # noqa: E402
+from yubicommon.qt.classes import Application  # noqa: E402
+from yubicommon.qt.utils import connect_once, _SignalConnector  # noqa: E402
+from yubicommon.qt.worker import Worker, _Event  # noqa: E402
+from yubicommon.stats import timer as _timer  # noqa: E402
+
+
+class Emitter(QtCore.QObject):
+    fired = QtCore.Signal()
+
+
+class SleepingWorker(Worker):
+    """Worker sleeping 10 ms before each job, as Worker used to."""
+
+    def work(self, job):
+        QtCore.QThread.msleep(10)
+        super(SleepingWorker, self).work(job)
+
+
+def run_jobs(app, worker, n):
+    """Post n no-op jobs, returning jobs/s once all callbacks have run."""
+    state = {'done': 0}
+
+    def callback(result):
+        state['done'] += 1
+        if state['done'] == n:
+            app.exit()
+
+    start = time.time()
+    for i in range(n):
+        worker.post_bg(int, callback)
+    app.exec_loop()
+    return n / (time.time() - start)
+
+
+def rss():
+    """Return the resident set size of the process in KiB, if known."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (IOError, OSError, ValueError):
+        try:
+            import resource
+        except ImportError:
+            return 0
+        # Peak rather than current size, but still shows steady growth.
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss // 1024 if sys.platform == 'darwin' else maxrss
+
+
+def live_events():
+    gc.collect()
+    return sum(1 for o in gc.get_objects() if isinstance(o, _Event))
+
+
+def percentiles(latencies):
+    ordered = sorted(latencies)
+
+    def at(fraction):
+        return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+    return {'p50': at(0.5), 'p90': at(0.9), 'p99': at(0.99),
+            'max': ordered[-1]}
+
+
+def stress(app, worker, mode, n):
+    """Post n jobs using the given method, returning the measurements.
+
+    Jobs using post show a modal dialog, so like in an application they are
+    posted one at a time, each once the previous one is done.
+    """
+    latencies = []
+    emitters = []
+    state = {'pending': 0}
+
+    def finished(posted):
+        latencies.append(_timer() - posted)
+        state['pending'] = max(state['pending'],
+                               len(worker._dispatcher._pending))
+        if len(latencies) == n:
+            app.exit()
+        elif mode == 'post':
+            # Post the next job from the event loop, once the dialog closed.
+            QtCore.QTimer.singleShot(0, post_one)
+
+    def post_one():
+        posted = _timer()
+        if mode == 'post_fg':
+            worker.post_fg(lambda: finished(posted))
+            return
+        # The job signals a connect_once slot on the GUI thread, whose
+        # connector must not be kept alive afterwards.
+        emitter = Emitter()
+        emitters.append(emitter)
+        connect_once(emitter.fired, int)
+        if mode == 'post':
+            worker.post('Working...', emitter.fired.emit,
+                        lambda result: finished(posted))
+        else:
+            worker.post_bg(emitter.fired.emit,
+                           lambda result: finished(posted))
+
+    worker.metrics.reset()
+    before = rss()
+    start = _timer()
+    for i in range(1 if mode == 'post' else n):
+        post_one()
+    app.exec_loop()
+    elapsed = _timer() - start
+    while worker._dispatcher._posted:  # Let any remaining callbacks run.
+        app.processEvents()
+    app.processEvents()
+    del emitters[:]
+
+    result = percentiles(latencies)
+    result.update({
+        'jobs': n,
+        'jobs_per_s': n / elapsed,
+        'max_queue_depth': worker.metrics.max_queue_depth,
+        'max_pending_callbacks': state['pending'],
+        'rss_growth_kib': rss() - before,
+        'live_events': live_events(),
+        'live_connectors': len(_SignalConnector._instances),
+        'live_dialogs': len(app.window.findChildren(QtGui.QProgressDialog))
+    })
+    return result
+
+
+def main():
+    as_json = '--json' in sys.argv
+    n = 2000
+    if '--jobs' in sys.argv:
+        n = int(sys.argv[sys.argv.index('--jobs') + 1])
+
+    app = Application()
+    app.exec_loop = super(Application, app).exec_
+
+    results = {}
+    baseline = SleepingWorker(app.window, None)
+    results['sleeping_jobs_per_s'] = run_jobs(app, baseline,
+                                              max(1, min(n, 200)))
+    baseline.stop()
+    results['thread_jobs_per_s'] = run_jobs(app, app.worker, n)
+    pool = Worker(app.window, None, max_workers=4)
+    results['pool_jobs_per_s'] = run_jobs(app, pool, n)
+    results['speedup'] = (results['thread_jobs_per_s'] /
+                          results['sleeping_jobs_per_s'])
+
+    stress(app, app.worker, 'post_bg', min(n, 100))  # Warm up.
+    results['stress'] = {}
+    for mode in ('post_bg', 'post', 'post_fg'):
+        results['stress'][mode] = stress(app, app.worker, mode, n)
+    results['stress']['pool_post_bg'] = stress(app, pool, 'post_bg', n)
+    pool.stop()
+    app.worker.stop()
+
+    leaks = [mode for mode, r in results['stress'].items()
+             if r['live_events'] or r['live_connectors'] or r['live_dialogs']]
+    if as_json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        for key, value in sorted(results.items()):
+            if key != 'stress':
+                print('%-22s %.1f' % (key, value))
+        for mode, r in sorted(results['stress'].items()):
+            print('%s: %d jobs, %.1f jobs/s, latency p50 %.6f p90 %.6f '
+                  'p99 %.6f max %.6f' % (mode, r['jobs'], r['jobs_per_s'],
+                                         r['p50'], r['p90'], r['p99'],
+                                         r['max']))
+            print('  max queue depth %d, max pending callbacks %d, '
+                  'rss growth %d KiB' % (r['max_queue_depth'],
+                                         r['max_pending_callbacks'],
+                                         r['rss_growth_kib']))
+            print('  live events %d, live connectors %d, live dialogs %d' % (
+                r['live_events'], r['live_connectors'], r['live_dialogs']))
+    if leaks:
+        print('Leaked objects after: %s' % ', '.join(sorted(leaks)),
+              file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
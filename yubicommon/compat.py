@@ -10,7 +10,8 @@ __all__ = [
     'binary_type',
     'text_type',
     'int2byte',
-    'byte2int'
+    'byte2int',
+    'with_metaclass'
 ]
 
 # Needed for isinstance() checks
@@ -39,3 +40,21 @@ def byte2int(i):
     if _PY2:
         return ord(i)
     return i
+
+
+def with_metaclass(meta, *bases):
+    """Create a base class with a metaclass, for use in class definitions.
+
+    Same behaviour as six.with_metaclass.
+    """
+    class metaclass(type):
+        # Replaces itself with the real metaclass when the class using it
+        # is created, so no intermediate class is left in its MRO.
+
+        def __new__(cls, name, this_bases, d):
+            return meta(name, bases, d)
+
+        @classmethod
+        def __prepare__(cls, name, this_bases):
+            return meta.__prepare__(name, bases)
+    return type.__new__(metaclass, 'temporary_class', (), {})
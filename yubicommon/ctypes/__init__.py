@@ -25,11 +25,71 @@
 # ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
-from .libloader import load_library
+from .libloader import load_library, registry
+from .buffers import Buffer, WritableBuffer, BufferPool
+from .profiling import profiler
+from ..compat import with_metaclass
+from functools import partial
+from itertools import starmap
+from multiprocessing.pool import ThreadPool
+import ctypes
 import os
 import sys
+import threading
 
-__all__ = ['load_library', 'use_library', 'CLibrary']
+__all__ = ['load_library', 'registry', 'use_library', 'CLibrary', 'EAGER',
+           'LAZY', 'OUT', 'Buffer', 'WritableBuffer', 'BufferPool',
+           'profiler']
+
+
+EAGER = 'eager'
+LAZY = 'lazy'
+
+
+class _Out(object):
+
+    def __repr__(self):
+        return 'OUT'
+
+
+# Placeholder for output arguments in CLibrary.map.
+OUT = _Out()
+
+
+def _undefined(func_name):
+    print("Undefined symbol: %s" % func_name)
+
+    def error(*args, **kwargs):
+        raise Exception("Undefined symbol: %s" % func_name)
+    return error
+
+
+def _bind(lib, func_name, argtypes, restype=None):
+    """Return a new foreign function object for func_name in lib.
+
+    Unlike getattr(lib, func_name) the returned object isn't shared with
+    other users of the library, so argtypes and restype can be set once.
+    """
+    try:
+        try:
+            f = lib[func_name]
+        except TypeError:  # Not subscriptable, as _WindowsLibrary.
+            f = getattr(lib, func_name)
+        f.argtypes = argtypes
+        f.restype = restype
+    except AttributeError:
+        return _undefined(func_name)
+    if profiler.enabled:
+        f = profiler.instrument(lib, func_name, f)
+    return f
+
+
+def _apply(fn, args):
+    return fn(*args)
+
+
+def _is_prototype(val):
+    return isinstance(val, tuple) and len(val) == 2
 
 
 def use_library(libname, version=None, extra_paths=[]):
@@ -41,16 +101,60 @@ def use_library(libname, version=None, extra_paths=[]):
             f.argtypes = argtypes
             f.restype = restype
         except AttributeError:
-            print("Undefined symbol: %s" % func_name)
-
-            def error(*args, **kwargs):
-                raise Exception("Undefined symbol: %s" % func_name)
-            f = error
+            return _undefined(func_name)
+        if profiler.enabled:
+            f = profiler.instrument(lib, func_name, f)
         return f
     return define
 
 
-class CLibrary(object):
+class _LazyFunction(object):
+    """Resolves a declared function on first access to it from an instance.
+
+    The bound function is then stored on the instance, shadowing this
+    descriptor, so further accesses are plain attribute lookups.
+    """
+
+    def __init__(self, name, prototype):
+        self.name = name
+        self.prototype = prototype
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self.prototype
+        lib = obj._handle()
+        bound = cls._bindings.setdefault(lib, {})
+        f = bound.get(self.name)
+        if f is None:
+            f = bound[self.name] = _bind(lib, self.name, *self.prototype)
+        obj.__dict__[self.name] = f
+        return f
+
+
+class _CLibraryMeta(type):
+
+    def __new__(mcs, name, bases, attrs):
+        prototypes = {}
+        for base in reversed(bases):
+            prototypes.update(getattr(base, '_prototypes', {}))
+        for key, val in attrs.items():
+            if _is_prototype(val):
+                prototypes[key] = val
+        attrs['_prototypes'] = prototypes
+        attrs['_bindings'] = {}  # Per library handle, never inherited.
+        attrs['_out_bindings'] = {}  # Used by map, per OUT positions.
+        cls = super(_CLibraryMeta, mcs).__new__(mcs, name, bases, attrs)
+        binding = getattr(cls, '_binding', None)
+        if binding in (EAGER, LAZY):
+            # Functions are plain instance attributes, skip the dispatch.
+            cls.__getattribute__ = object.__getattribute__
+        if binding == LAZY:
+            for key, val in prototypes.items():
+                setattr(cls, key, _LazyFunction(key, val))
+        return cls
+
+
+class CLibrary(with_metaclass(_CLibraryMeta)):
     """
     Base class for extending to create python wrappers for c libraries.
 
@@ -61,11 +165,155 @@ class CLibrary(object):
         foo = Foo('libfoo')
 
         assert foo.foo_func(True, 'Hello!') == 7
+
+    By default each access to a declared function looks it up in the library
+    and sets its prototype. Setting _binding = EAGER on the class instead
+    binds all declared functions once per class and library, after which
+    calling them costs no more than calling a plain ctypes function.
+    Setting _binding = LAZY defers loading the library until a function is
+    first used, and binds each function on its first use.
+
+    Use map to call a function with many sets of arguments, see CLibrary.map.
+
+    Arguments declared as Buffer accept any object supporting the buffer
+    protocol, and arguments declared as WritableBuffer accept writable ones
+    (such as bytearray, mmap or array.array), which are passed to the
+    function without being copied. Other argument types are left as
+    declared. A BufferPool can be used to reuse buffers for functions
+    writing output to caller provided memory.
+
+    Calls can be profiled by enabling the profiler before the functions are
+    bound, see yubicommon.ctypes.profiling.
     """
+    _binding = None
+    _thread_safe = frozenset()  # Functions that map may call concurrently.
+
     def __init__(self, libname, version=None):
         module_path = sys.modules[self.__class__.__module__].__file__
         extra_paths = [os.path.dirname(module_path)]
-        self._lib = use_library(libname, version, extra_paths)
+        self._lib_args = (libname, version, extra_paths)
+        self._map_lock = threading.Lock()
+        self._map_pools = {}  # Per number of threads.
+        self._out_buffers = {}
+        if self._binding == EAGER:
+            self._bind_all(self._handle())
+        if self._binding != LAZY:
+            self._lib = use_library(libname, version, extra_paths)
+
+    def _handle(self):
+        return load_library(*self._lib_args)
+
+    def _bind_all(self, lib):
+        cls = type(self)
+        bound = cls._bindings.get(lib)
+        if bound is None:
+            bound = dict((name, _bind(lib, name, *proto))
+                         for name, proto in cls._prototypes.items())
+            cls._bindings[lib] = bound
+        self.__dict__.update(bound)
+
+    @property
+    def aio(self):
+        """An AsyncCLibrary for this library, see yubicommon.ctypes.aio."""
+        aio = self.__dict__.get('_aio')
+        if aio is None:
+            from .aio import AsyncCLibrary
+            aio = self._aio = AsyncCLibrary(self)
+        return aio
+
+    def _out_binding(self, func_name, positions):
+        # Re-binds func_name with plain addresses for the OUT arguments.
+        lib = self._handle()
+        key = (lib, func_name, positions)
+        func = self._out_bindings.get(key)
+        if func is None:
+            argtypes, restype = self._prototypes[func_name]
+            argtypes = list(argtypes)
+            for i in positions:
+                argtypes[i] = ctypes.c_void_p
+            func = self._out_bindings[key] = _bind(lib, func_name, argtypes,
+                                                   restype)
+        return func
+
+    def _out_buffer(self, target, n):
+        # Reuses the largest free array of target, if it is large enough.
+        with self._map_lock:
+            free = self._out_buffers.get(target)
+            if free and len(free[-1]) >= n:
+                return free.pop()
+        return (target * n)()
+
+    def _release_out_buffer(self, target, buf):
+        with self._map_lock:
+            free = self._out_buffers.setdefault(target, [])
+            free.append(buf)
+            free.sort(key=len)
+            del free[:-2]
+
+    def _pool(self, threads):
+        with self._map_lock:
+            pool = self._map_pools.get(threads)
+            if pool is None:
+                pool = self._map_pools[threads] = ThreadPool(threads)
+            return pool
+
+    def close(self):
+        """Stop the threads of the pools used by map."""
+        with self._map_lock:
+            pools, self._map_pools = self._map_pools, {}
+        for pool in pools.values():
+            pool.close()
+            pool.join()
+
+    def map(self, func_name, args, threads=None):
+        """Call a declared function once for each tuple of arguments in args.
+
+        Returns a list with the result of each call. Arguments passed as OUT
+        must be declared as POINTER(T). A contiguous T array is used for
+        each such argument and shared by all the calls, and each result is
+        then a tuple of the return value followed by the output values.
+        The positions of OUT arguments are taken from the first tuple. The
+        arrays and the function bound for them are reused by later calls.
+
+        If threads is given, the calls are spread over a pool of that many
+        threads, which is kept for later calls until close is called. This
+        is only allowed for functions listed in _thread_safe.
+        """
+        rows = list(args)
+        n = len(rows)
+        outputs = []
+        if rows and OUT in rows[0]:
+            argtypes = self._prototypes[func_name][0]
+            positions = tuple(i for i, arg in enumerate(rows[0])
+                              if arg is OUT)
+            columns = [list(column) for column in zip(*rows)]
+            for i in positions:
+                target = argtypes[i]._type_
+                buf = self._out_buffer(target, n)
+                base = ctypes.addressof(buf)
+                size = ctypes.sizeof(target)
+                # Pass plain addresses into the buffer.
+                columns[i] = range(base, base + n * size, size)
+                outputs.append((target, buf))
+            rows = list(zip(*columns))
+            func = self._out_binding(func_name, positions)
+        else:
+            func = getattr(self, func_name)
+
+        try:
+            if threads:
+                if func_name not in self._thread_safe:
+                    raise ValueError('%s is not thread safe' % func_name)
+                results = self._pool(threads).map(
+                    partial(_apply, func), rows, max(1, n // (threads * 4)))
+            else:
+                results = list(starmap(func, rows))
+            if outputs:
+                return list(zip(results, *[buf[:n] for _, buf in outputs]))
+            return results
+        finally:
+            for target, buf in outputs:
+                self._release_out_buffer(target, buf)
 
     def __getattribute__(self, name):
         val = object.__getattribute__(self, name)
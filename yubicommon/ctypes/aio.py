@@ -0,0 +1,124 @@
+# Copyright (c) 2013 Yubico AB
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#    1. Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    2. Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""asyncio support for CLibrary, requires Python 3.5 or later."""
+
+from __future__ import absolute_import
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import asyncio
+import ctypes
+
+__all__ = ['AsyncCLibrary', 'first_argument']
+
+
+_CArgObject = type(ctypes.byref(ctypes.c_int()))
+
+
+def first_argument(args):
+    """Default serialization key, the handle passed as first argument.
+
+    Only pointer-like handles are used as keys: pointers, c_void_p values,
+    and structures or unions, passed directly or by reference. These are
+    keyed on the address they refer to, so calls passing the same device
+    handle are serialized even if the objects differ. Calls passing any
+    other first argument are not serialized.
+    """
+    if not args:
+        return None
+    handle = args[0]
+    if isinstance(handle, _CArgObject):
+        handle = handle._obj
+        if not isinstance(handle, (ctypes.Structure, ctypes.Union)):
+            return None
+    if isinstance(handle, ctypes._Pointer):
+        return ctypes.cast(handle, ctypes.c_void_p).value
+    if isinstance(handle, ctypes.c_void_p):
+        return handle.value
+    if isinstance(handle, (ctypes.Structure, ctypes.Union)):
+        return ctypes.addressof(handle)
+    return None
+
+
+class AsyncCLibrary(object):
+    """Runs the functions declared by a CLibrary in a bounded thread pool.
+
+    Each declared function is available as a coroutine function. Calls with
+    the same key (by default the first handle, see first_argument) run
+    one at a time in the order they were made, while calls with different
+    keys run in parallel. Pass key=None to not serialize any calls.
+
+    Example:
+        ykpers = AsyncCLibrary(YkPers('ykpers-1'))
+        status = await ykpers.yk_get_status(device, st)
+    """
+
+    def __init__(self, lib, max_workers=4, executor=None,
+                 key=first_argument):
+        self._lib = lib
+        self._own_executor = executor is None
+        self._executor = executor or ThreadPoolExecutor(max_workers)
+        self._key = key
+        self._locks = {}
+
+    def __getattr__(self, name):
+        if name not in type(self._lib)._prototypes:
+            raise AttributeError(name)
+        func = getattr(self._lib, name)
+
+        async def call(*args):
+            return await self._run(partial(func, *args), args)
+        call.__name__ = name
+        setattr(self, name, call)
+        return call
+
+    async def _run(self, fn, args):
+        loop = asyncio.get_event_loop()
+        key = self._key(args) if self._key else None
+        if key is None:
+            return await loop.run_in_executor(self._executor, fn)
+
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                return await loop.run_in_executor(self._executor, fn)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    def close(self):
+        """Shut down the thread pool, if it was created by this instance."""
+        if self._own_executor:
+            self._executor.shutdown(wait=False)
+
+    def __repr__(self):
+        return 'AsyncCLibrary(%r)' % self._lib
@@ -0,0 +1,181 @@
+# Copyright (c) 2013 Yubico AB
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#    1. Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    2. Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Passing objects supporting the buffer protocol to C without copying."""
+
+from __future__ import absolute_import
+
+from contextlib import contextmanager
+import ctypes
+import sys
+import threading
+
+__all__ = ['Buffer', 'WritableBuffer', 'BufferPool']
+
+
+class _Py_buffer(ctypes.Structure):
+    _fields_ = [
+        ('buf', ctypes.c_void_p),
+        ('obj', ctypes.c_void_p),
+        ('len', ctypes.c_ssize_t),
+        ('itemsize', ctypes.c_ssize_t),
+        ('readonly', ctypes.c_int),
+        ('ndim', ctypes.c_int),
+        ('format', ctypes.c_char_p),
+        ('shape', ctypes.c_void_p),
+        ('strides', ctypes.c_void_p),
+        ('suboffsets', ctypes.c_void_p)
+    ] + ([('smalltable', ctypes.c_ssize_t * 2)]
+         if sys.version_info < (3, 0) else []) + [
+        ('internal', ctypes.c_void_p)
+    ]
+
+
+_PyBUF_SIMPLE = 0
+
+_get_buffer = ctypes.pythonapi.PyObject_GetBuffer
+_get_buffer.argtypes = [ctypes.py_object, ctypes.POINTER(_Py_buffer),
+                        ctypes.c_int]
+_get_buffer.restype = ctypes.c_int
+
+_release_buffer = ctypes.pythonapi.PyBuffer_Release
+_release_buffer.argtypes = [ctypes.POINTER(_Py_buffer)]
+_release_buffer.restype = None
+
+
+class _ReadOnlyView(ctypes.c_void_p):
+    """Pointer to the memory of a read-only buffer, held until collected."""
+
+    def __init__(self, obj):
+        view = _Py_buffer()
+        _get_buffer(obj, ctypes.byref(view), _PyBUF_SIMPLE)
+        super(_ReadOnlyView, self).__init__(view.buf)
+        self._view = view
+
+    def __del__(self):
+        _release_buffer(ctypes.byref(self._view))
+
+
+def _read_only_error(obj):
+    return TypeError('A writable buffer is required, got a read-only %s'
+                     % type(obj).__name__)
+
+
+def _buffer_param(obj, view, writable):
+    if not view.readonly:
+        # A zero length array is enough to get at the address.
+        return (ctypes.c_char * 0).from_buffer(obj)
+    if writable:
+        raise _read_only_error(obj)
+    return _ReadOnlyView(obj)
+
+
+def _from_param(argtype, obj, writable):
+    if writable:
+        # The base types accept bytes, which must not be written to.
+        try:
+            readonly = memoryview(obj).readonly
+        except TypeError:
+            readonly = False
+        if readonly:
+            raise _read_only_error(obj)
+    try:
+        return argtype.from_param(obj)
+    except TypeError:
+        try:
+            view = memoryview(obj)
+        except TypeError:
+            raise TypeError('Expected %s or a buffer, got %s'
+                            % (argtype.__name__, type(obj).__name__))
+        return _buffer_param(obj, view, writable)
+
+
+class Buffer(ctypes.c_char_p):
+    """Argument type for a const char pointer, accepting any buffer.
+
+    Accepts what c_char_p does, as well as any object supporting the buffer
+    protocol, the address of which is passed without copying.
+    """
+
+    @classmethod
+    def from_param(cls, obj):
+        return _from_param(ctypes.c_char_p, obj, False)
+
+
+class WritableBuffer(ctypes.POINTER(ctypes.c_char)):
+    """Argument type for a char pointer, accepting any writable buffer.
+
+    Accepts what POINTER(c_char) does, as well as writable objects
+    supporting the buffer protocol (such as bytearray, mmap or array.array),
+    the address of which is passed without copying.
+    """
+
+    @classmethod
+    def from_param(cls, obj):
+        return _from_param(ctypes.POINTER(ctypes.c_char), obj, True)
+
+
+class BufferPool(object):
+    """Reusable output buffers for functions writing to caller memory.
+
+    Example:
+        pool = BufferPool()
+        with pool.buffer(64) as buf:
+            lib.read_data(buf, len(buf))
+            data = bytes(buf)
+    """
+
+    def __init__(self, max_free=8):
+        self._max_free = max_free
+        self._free = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, size):
+        """Return a zeroed bytearray of the given size."""
+        with self._lock:
+            free = self._free.get(size)
+            if free:
+                return free.pop()
+        return bytearray(size)
+
+    def release(self, buf):
+        # Clear the contents, buffers may have held sensitive data.
+        if buf:
+            ctypes.memset((ctypes.c_char * len(buf)).from_buffer(buf),
+                          0, len(buf))
+        with self._lock:
+            free = self._free.setdefault(len(buf), [])
+            if len(free) < self._max_free:
+                free.append(buf)
+
+    @contextmanager
+    def buffer(self, size):
+        buf = self.acquire(size)
+        try:
+            yield buf
+        finally:
+            self.release(buf)
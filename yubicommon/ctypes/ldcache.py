@@ -0,0 +1,209 @@
+# Copyright (c) 2013 Yubico AB
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#    1. Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    2. Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Reader for the binary /etc/ld.so.cache file maintained by ldconfig.
+
+This lets library lookups on glibc based systems be resolved without running
+ldconfig, gcc or objdump in a subprocess, as ctypes.util.find_library does.
+"""
+
+from __future__ import absolute_import
+
+import mmap
+import platform
+import re
+import struct
+import sys
+import sysconfig
+
+__all__ = ['LdSoCache']
+
+
+OLD_MAGIC = b'ld.so-1.7.0'
+NEW_MAGIC = b'glibc-ld.so.cache1.1'
+
+_OLD_HEADER = struct.Struct('=11sxI')  # magic, nlibs
+_OLD_ENTRY = struct.Struct('=iII')  # flags, key, value
+_NEW_HEADER = struct.Struct('=20sIIB3xI12x')  # magic, nlibs, len_strings, ...
+_NEW_ENTRY = struct.Struct('=iIIIQ')  # flags, key, value, osversion, hwcap
+
+FLAG_TYPE_MASK = 0x00ff
+FLAG_REQUIRED_MASK = 0xff00
+FLAG_ELF_LIBC6 = 0x0003
+
+# Values of FLAG_REQUIRED_MASK accepted for the running interpreter, from
+# glibc's ldconfig.h.
+_ARCH_FLAGS = {
+    ('x86_64', '64bit'): (0x0300,),
+    ('amd64', '64bit'): (0x0300,),
+    ('aarch64', '64bit'): (0x0a00,),
+    ('arm64', '64bit'): (0x0a00,),
+    ('ppc64', '64bit'): (0x0500,),
+    ('ppc64le', '64bit'): (0x0500,),
+    ('s390x', '64bit'): (0x0400,),
+    ('sparc64', '64bit'): (0x0100,),
+    ('ia64', '64bit'): (0x0200,),
+    ('mips64', '64bit'): (0x0700, 0x0e00),
+    ('riscv64', '64bit'): (0x1000, 0x0f00),
+    ('loongarch64', '64bit'): (0x1200, 0x1100),
+}
+
+
+def _arch_flags():
+    machine = platform.machine().lower()
+    bits = platform.architecture()[0]
+    if (machine, bits) in _ARCH_FLAGS:
+        return _ARCH_FLAGS[(machine, bits)]
+    # machine is that of the kernel, a 32 bit interpreter may run on a 64
+    # bit kernel.
+    if machine in ('x86_64', 'amd64') and bits == '32bit':
+        multiarch = sysconfig.get_config_var('MULTIARCH') or ''
+        return (0x0800,) if multiarch.endswith('gnux32') else (0,)
+    if machine.startswith('arm') or machine == 'aarch64':
+        return (0, 0x0900, 0x0b00)  # Hard or soft float.
+    if bits == '32bit':
+        return (0,)
+    return None  # Unknown, accept anything.
+
+
+def _decode(name):
+    if isinstance(name, str):
+        return name
+    return name.decode(sys.getfilesystemencoding() or 'utf-8')
+
+
+class LdSoCache(object):
+    """Soname to path lookups backed by a memory mapped ld.so.cache file.
+
+    Both the old (libc5) and new (glibc 2.x) layouts are supported, as well as
+    the combined layout where a new format cache is appended to an old one.
+    Only libc6 entries built for the current architecture are used, and
+    entries that require hardware capabilities (found in hwcap
+    subdirectories) are skipped, as their availability cannot be verified
+    without the dynamic linker.
+    """
+
+    _lib_re = re.compile(r'lib(.*?)\.so(?:\.|$)')
+
+    def __init__(self, path='/etc/ld.so.cache'):
+        self.path = path
+        self._by_soname = None
+        self._by_name = None
+
+    def _load(self):
+        by_soname = {}
+        by_name = {}
+        try:
+            with open(self.path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            data = None  # Missing or empty file.
+        if data is not None:
+            try:
+                entries = self._parse(data)
+            except (struct.error, ValueError):
+                entries = []
+            finally:
+                data.close()
+
+            accepted = _arch_flags()
+            for flags, hwcap, soname, path in entries:
+                if flags & FLAG_TYPE_MASK != FLAG_ELF_LIBC6:
+                    continue
+                if accepted is not None and \
+                        flags & FLAG_REQUIRED_MASK not in accepted:
+                    continue
+                if hwcap:
+                    continue
+                # ldconfig sorts entries by preference, keep the first one.
+                by_soname.setdefault(soname, path)
+                match = self._lib_re.match(soname)
+                if match:
+                    by_name.setdefault(match.group(1), path)
+
+        self._by_name = by_name
+        self._by_soname = by_soname
+
+    def _parse(self, data):
+        if data[:len(NEW_MAGIC)] == NEW_MAGIC:
+            return self._parse_new(data, 0)
+        if data[:len(OLD_MAGIC)] != OLD_MAGIC:
+            raise ValueError('Unknown ld.so.cache format')
+
+        _, nlibs = _OLD_HEADER.unpack_from(data, 0)
+        strings = _OLD_HEADER.size + nlibs * _OLD_ENTRY.size
+        # A new format cache may follow, aligned to 8 bytes.
+        new_offset = (strings + 7) & ~7
+        if data[new_offset:new_offset + len(NEW_MAGIC)] == NEW_MAGIC:
+            return self._parse_new(data, new_offset)
+
+        entries = []
+        for i in range(nlibs):
+            flags, key, value = _OLD_ENTRY.unpack_from(
+                data, _OLD_HEADER.size + i * _OLD_ENTRY.size)
+            entries.append((flags, 0, self._string(data, strings + key),
+                            self._string(data, strings + value)))
+        return entries
+
+    def _parse_new(self, data, base):
+        _, nlibs, _, _, _ = _NEW_HEADER.unpack_from(data, base)
+        entries = []
+        for i in range(nlibs):
+            flags, key, value, _, hwcap = _NEW_ENTRY.unpack_from(
+                data, base + _NEW_HEADER.size + i * _NEW_ENTRY.size)
+            entries.append((flags, hwcap, self._string(data, base + key),
+                            self._string(data, base + value)))
+        return entries
+
+    @staticmethod
+    def _string(data, offset):
+        end = data.find(b'\0', offset)
+        if end < 0:
+            raise ValueError('Unterminated string in ld.so.cache')
+        return _decode(data[offset:end])
+
+    def find(self, libname, version=None):
+        """Return the path of a library given by name or soname, or None.
+
+        libname can be given either as a full soname ("libc.so.6") or in the
+        format accepted by ctypes.util.find_library ("c").
+        """
+        if self._by_soname is None:
+            self._load()
+        if version:
+            path = self._by_soname.get('lib%s.so.%s' % (libname, version))
+            if path:
+                return path
+        return self._by_soname.get(libname) or self._by_name.get(libname)
+
+    def __contains__(self, libname):
+        return self.find(libname) is not None
+
+    def __len__(self):
+        if self._by_soname is None:
+            self._load()
+        return len(self._by_soname)
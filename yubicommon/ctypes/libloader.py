@@ -38,9 +38,15 @@ import os.path
 import re
 import sys
 import glob
+import json
 import platform
+import threading
+import time
 import ctypes
 import ctypes.util
+from collections import OrderedDict
+
+from .ldcache import LdSoCache
 
 
 def _environ_path(name):
@@ -50,6 +56,59 @@ def _environ_path(name):
         return []
 
 
+LD_SO_CACHE_VERSION = 1
+
+# Directories listed by other processes are kept up to this many in total.
+LD_SO_CACHE_MAX_DIRECTORIES = 256
+
+# Listings of directories modified less than this many seconds before they
+# were read are not persisted, as the directory may have changed since
+# without its mtime changing (covers the 2 second resolution of FAT).
+LD_SO_CACHE_RACY_INTERVAL = 2.0
+
+
+def _ld_so_cache_file():
+    """Return the path of the persistent ld.so search cache, if enabled.
+
+    The location can be overridden with YUBICOMMON_LD_CACHE, setting it to an
+    empty string disables the persistent cache.
+    """
+    path = os.environ.get('YUBICOMMON_LD_CACHE')
+    if path is None:
+        cache_home = os.environ.get('XDG_CACHE_HOME') or \
+            os.path.join(os.path.expanduser('~'), '.cache')
+        path = os.path.join(cache_home, 'yubicommon', 'ld_so_cache.json')
+    return path or None
+
+
+def _read_ld_so_cache_file(path):
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f, object_pairs_hook=OrderedDict)
+        if data.get('version') == LD_SO_CACHE_VERSION:
+            return data['directories']
+    except (IOError, OSError, ValueError, KeyError, AttributeError):
+        pass
+    return OrderedDict()
+
+
+def _write_ld_so_cache_file(path, directories):
+    data = {'version': LD_SO_CACHE_VERSION, 'directories': directories}
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+
 class LibraryLoader(object):
 
     def __init__(self):
@@ -163,12 +222,22 @@ class DarwinLibraryLoader(LibraryLoader):
 
 class PosixLibraryLoader(LibraryLoader):
     _ld_so_cache = None
+    _ld_cache = LdSoCache()
 
     def load_library(self, libname, version=None, extra_paths=[]):
         for dir in extra_paths:  # Favor extra_paths
             for path in glob.glob("%s/lib%s*.s[ol]*" % (dir, libname)):
                 return self.load(path)
 
+        # Resolve using ld.so.cache directly, avoiding the subprocesses
+        # spawned by ctypes.util.find_library.
+        found = self._ld_cache.find(libname, version)
+        if found is not None:
+            try:
+                return self.load(found)
+            except ImportError:
+                pass
+
         try:
             found = ctypes.util.find_library(libname)
             if found is not None:
@@ -222,28 +291,72 @@ class PosixLibraryLoader(LibraryLoader):
                 unix_lib_dirs_list += glob.glob('/lib/*linux-gnu')
         directories.extend(unix_lib_dirs_list)
 
+        listings = self._list_directories(directories)
+
         cache = {}
         lib_re = re.compile(r'lib(.*)\.s[ol]')
         for dir in directories:
-            try:
-                for path in glob.glob("%s/*.s[ol]*" % dir):
-                    file = os.path.basename(path)
-
-                    # Index by filename
-                    if file not in cache:
-                        cache[file] = path
-
-                    # Index by library name
-                    match = lib_re.match(file)
-                    if match:
-                        library = match.group(1)
-                        if library not in cache:
-                            cache[library] = path
-            except OSError:
-                pass
+            for path in listings.get(dir, []):
+                file = os.path.basename(path)
+
+                # Index by filename
+                if file not in cache:
+                    cache[file] = path
+
+                # Index by library name
+                match = lib_re.match(file)
+                if match:
+                    library = match.group(1)
+                    if library not in cache:
+                        cache[library] = path
 
         self._ld_so_cache = cache
 
+    def _list_directories(self, directories):
+        # Globbing every directory is what makes the cache slow to build, so
+        # the listings are persisted between processes.  Each directory is
+        # stored with its mtime and rescanned only when that changes.
+        # Relative directories depend on the cwd and are never persisted,
+        # nor are listings which may be racy, see LD_SO_CACHE_RACY_INTERVAL.
+        # Entries of directories used by other processes are kept, so that
+        # processes with different search paths don't evict each other.
+        cache_file = _ld_so_cache_file()
+        stored = _read_ld_so_cache_file(cache_file) if cache_file else {}
+
+        listings = {}
+        entries = OrderedDict(stored)
+        changed = False
+        for dir in directories:
+            if dir in listings:
+                continue
+            try:
+                mtime = os.stat(dir).st_mtime
+            except OSError:
+                mtime = None
+            entry = stored.get(dir)
+            if entry is None or entry[0] != mtime or not os.path.isabs(dir):
+                paths = []
+                if mtime is not None:
+                    try:
+                        paths = glob.glob("%s/*.s[ol]*" % dir)
+                    except OSError:
+                        pass
+                entry = [mtime, paths]
+                if os.path.isabs(dir):
+                    entries.pop(dir, None)  # Move to the end, as newest.
+                    if mtime is None or time.time() - mtime >= \
+                            LD_SO_CACHE_RACY_INTERVAL:
+                        entries[dir] = entry
+                    changed = True
+            listings[dir] = entry[1]
+
+        if cache_file and changed:
+            excess = len(entries) - LD_SO_CACHE_MAX_DIRECTORIES
+            for dir in [d for d in entries if d not in listings][:excess]:
+                del entries[dir]
+            _write_ld_so_cache_file(cache_file, entries)
+        return listings
+
     def getplatformpaths(self, libname, extra_paths):
         if self._ld_so_cache is None:
             self._create_ld_so_cache()
@@ -350,8 +463,67 @@ loader = loaderclass.get(sys.platform, PosixLibraryLoader)()
 
 def add_library_search_dirs(other_dirs):
     loader.other_dirs = other_dirs
+    registry.invalidate()
+
+
+class LibraryRegistry(object):
+    """Process wide cache of loaded libraries.
+
+    Libraries are keyed on (libname, version, extra_paths), so repeated loads
+    return the same handle without searching the filesystem again.
+    Concurrent first loads of the same library are serialized so that the
+    search is only done once.
+    """
+
+    def __init__(self, load):
+        self._load = load
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._libs = {}
+        self._hits = 0
+        self._misses = 0
+
+    def load_library(self, libname, version=None, extra_paths=[]):
+        key = (libname, version, tuple(extra_paths))
+        lib = self._libs.get(key)
+        if lib is not None:
+            self._hits += 1
+            return lib
+
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            lib = self._libs.get(key)
+            if lib is None:
+                self._misses += 1
+                lib = self._load(libname, version, extra_paths)
+                self._libs[key] = lib
+            else:
+                self._hits += 1
+        return lib
+
+    def invalidate(self, libname=None):
+        """Forget loaded libraries, all of them or those named libname.
+
+        Already loaded handles stay valid, but subsequent loads will search
+        for the library again.
+        """
+        with self._lock:
+            for key in list(self._libs):
+                if libname is None or key[0] == libname:
+                    del self._libs[key]
+                    self._key_locks.pop(key, None)
+
+    def stats(self):
+        return {
+            'libraries': len(self._libs),
+            'hits': self._hits,
+            'misses': self._misses
+        }
+
 
+registry = LibraryRegistry(loader.load_library)
 
-load_library = loader.load_library
+load_library = registry.load_library
 
 del loaderclass
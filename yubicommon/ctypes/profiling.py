@@ -0,0 +1,171 @@
+# Copyright (c) 2013 Yubico AB
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#    1. Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    2. Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Opt-in profiling of foreign function calls made through CLibrary.
+
+Profiling is enabled by calling profiler.enable(), or by setting the
+YUBICOMMON_PROFILE_CALLS environment variable, before the functions to
+profile are bound (see CLibrary). When disabled, functions are bound exactly
+as before and no overhead is added.
+"""
+
+from __future__ import absolute_import
+
+from collections import deque
+from ..stats import timer as _timer, StatsCollector
+import ctypes
+import os
+import threading
+
+__all__ = ['profiler', 'CallProfiler']
+
+
+def _percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class _FunctionStats(object):
+
+    def __init__(self, samples):
+        self.calls = 0
+        self.marshal = 0.0
+        self.native = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=samples)
+
+    def add(self, marshal, native):
+        total = marshal + native
+        self.calls += 1
+        self.marshal += marshal
+        self.native += native
+        self.max = max(self.max, total)
+        self.samples.append(total)
+
+    def to_dict(self):
+        ordered = sorted(self.samples)
+        return {
+            'calls': self.calls,
+            'total': self.marshal + self.native,
+            'marshal': self.marshal,
+            'native': self.native,
+            'p50': _percentile(ordered, 0.50),
+            'p90': _percentile(ordered, 0.90),
+            'p99': _percentile(ordered, 0.99),
+            'max': self.max
+        }
+
+
+class CallProfiler(StatsCollector):
+    """Collects call counts and latencies of foreign functions.
+
+    Times are in seconds. Marshalling time is the time spent converting the
+    arguments according to argtypes, native time is the remaining time spent
+    in the call. Percentiles are computed over the most recent calls. Hooks
+    are called with (name, args, marshal_time, native_time) after each call.
+    """
+
+    def __init__(self, samples=1024):
+        super(CallProfiler, self).__init__()
+        self.enabled = False
+        self._samples = samples
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._wrappers = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        """Stop profiling functions bound from now on."""
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    def instrument(self, lib, func_name, f):
+        """Return a profiling wrapper around the foreign function f."""
+        if not isinstance(f, ctypes._CFuncPtr):
+            return f  # Undefined symbol.
+        key = (lib, func_name, tuple(f.argtypes or ()), f.restype)
+        with self._lock:
+            wrapper = self._wrappers.get(key)
+        if wrapper is None:
+            wrapper = self._wrap(lib, func_name, f)
+            with self._lock:
+                self._wrappers[key] = wrapper
+        return wrapper
+
+    def _wrap(self, lib, func_name, f):
+        name = '%s:%s' % (os.path.basename(getattr(lib, '_name', '?')),
+                          func_name)
+        argtypes = f.argtypes or []
+        try:
+            # Called with arguments already converted, to time it separately.
+            raw = lib[func_name]
+            raw.restype = f.restype
+        except TypeError:
+            raw = None
+        record = self._record
+        converters = [t.from_param for t in argtypes]
+
+        def wrapper(*args):
+            start = _timer()
+            if raw is not None and len(args) == len(converters):
+                converted = [c(a) for (c, a) in zip(converters, args)]
+                called = _timer()
+                result = raw(*converted)
+            else:
+                called = start
+                result = f(*args)
+            record(name, args, called - start, _timer() - called)
+            return result
+        wrapper.__name__ = str(func_name)
+        return wrapper
+
+    def _record(self, name, args, marshal, native):
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = self._stats[name] = _FunctionStats(self._samples)
+            stats.add(marshal, native)
+        self._call_hooks(name, args, marshal, native)
+
+    def stats(self):
+        """Return a dict of per function statistics, keyed on lib:function.
+        """
+        with self._lock:
+            return dict((name, stats.to_dict())
+                        for name, stats in self._stats.items())
+
+
+profiler = CallProfiler()
+
+if os.getenv('YUBICOMMON_PROFILE_CALLS'):
+    profiler.enable()
@@ -0,0 +1,219 @@
+# Copyright (c) 2014 Yubico AB
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Additional permission under GNU GPL version 3 section 7
+#
+# If you modify this program, or any covered work, by linking or
+# combining it with the OpenSSL project's OpenSSL library (or a
+# modified version of that library), containing parts covered by the
+# terms of the OpenSSL or SSLeay licenses, We grant you additional
+# permission to convey the resulting work. Corresponding Source for a
+# non-source form of such a combination shall include the source code
+# for the parts of OpenSSL used as well as that of the covered work.
+
+"""asyncio support for the Qt event loop, requires Python 3.5 or later.
+
+The asyncio event loop returned by get_event_loop runs on the GUI thread,
+stepped from the Qt event loop whenever it has work to do, so coroutines
+can use widgets directly and Application.exec_ runs both loops.
+"""
+
+from __future__ import absolute_import
+
+from PySide import QtCore
+from ..stats import timer as _timer
+from functools import partial
+import asyncio
+import math
+import selectors
+
+__all__ = ['QtEventLoopDriver', 'get_event_loop', 'run_job']
+
+# Selectors which can be waited on through their own file descriptor.
+_POLLABLE_SELECTORS = tuple(getattr(selectors, name) for name in
+                            ('EpollSelector', 'KqueueSelector')
+                            if hasattr(selectors, name))
+
+# Longest interval a QTimer accepts, in milliseconds.
+_MAX_INTERVAL = 2 ** 31 - 1
+
+
+class _QtSelectorEventLoop(asyncio.SelectorEventLoop):
+    """Selector event loop waking its driver when given work from outside.
+
+    Callbacks scheduled while the loop isn't running, such as tasks created
+    by Qt slots, only change its queues, so the driver is told to step it.
+    """
+    _driver = None
+
+    def call_soon(self, *args, **kwargs):
+        handle = super(_QtSelectorEventLoop, self).call_soon(*args, **kwargs)
+        self._wake()
+        return handle
+
+    def call_at(self, *args, **kwargs):
+        handle = super(_QtSelectorEventLoop, self).call_at(*args, **kwargs)
+        self._wake()
+        return handle
+
+    def _wake(self):
+        if self._driver is not None and not self.is_running():
+            self._driver.wake()
+
+
+class QtEventLoopDriver(QtCore.QObject):
+    """Runs an asyncio event loop from the Qt event loop.
+
+    The asyncio loop runs one iteration at a time, handling ready I/O and
+    callbacks without blocking. Iterations are run as soon as callbacks are
+    ready or the earliest scheduled callback is due, and whenever the
+    selector of the loop reports I/O, including wakeups by
+    call_soon_threadsafe. While there is nothing to do, nothing is run.
+
+    A loop given as loop, or using a selector which can't be watched by Qt,
+    is instead also stepped every interval milliseconds while idle. The loop
+    is not run from within itself, for instance while a coroutine shows a
+    modal dialog.
+    """
+
+    def __init__(self, loop=None, interval=10, parent=None):
+        super(QtEventLoopDriver, self).__init__(parent)
+        if loop is None:
+            loop = _QtSelectorEventLoop()
+            loop._driver = self
+        self.loop = loop
+        self.interval = interval
+        asyncio.set_event_loop(loop)
+        self._timer = QtCore.QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self._step)
+        self._close_pending = False
+        selector = getattr(loop, '_selector', None)
+        if isinstance(loop, _QtSelectorEventLoop) and \
+                isinstance(selector, _POLLABLE_SELECTORS):
+            self._notifier = QtCore.QSocketNotifier(
+                selector.fileno(), QtCore.QSocketNotifier.Read, self)
+            self._notifier.activated.connect(self._step)
+        else:
+            self._notifier = None
+        self._schedule()
+
+    def wake(self):
+        """Run an iteration of the loop from the Qt event loop, soon."""
+        self._timer.start(0)
+
+    def _step(self):
+        if self._notifier is not None:
+            # Stays disabled while the loop runs, as it is level triggered.
+            self._notifier.setEnabled(False)
+        if self.loop.is_running() or self.loop.is_closed():
+            return
+        self.loop.call_soon(self.loop.stop)
+        self.loop.run_forever()
+        if self._close_pending:
+            self.close()
+        else:
+            self._schedule()
+
+    def _schedule(self):
+        if self.loop.is_closed():
+            return
+        if self._notifier is not None:
+            self._notifier.setEnabled(True)
+        if self.loop._ready:
+            self._timer.start(0)
+            return
+        timeout = None
+        scheduled = self.loop._scheduled
+        if scheduled:
+            timeout = int(math.ceil(
+                (scheduled[0]._when - self.loop.time()) * 1000))
+        if self._notifier is None:
+            timeout = min(timeout, self.interval) if timeout is not None \
+                else self.interval
+        if timeout is None:
+            self._timer.stop()
+        else:
+            self._timer.start(min(max(timeout, 0), _MAX_INTERVAL))
+
+    def close(self):
+        """Cancel all pending tasks and close the loop.
+
+        If called from a callback of the loop, the loop is closed once the
+        callback returns.
+        """
+        if self.loop.is_running():
+            self._close_pending = True
+            return
+        self._timer.stop()
+        if self._notifier is not None:
+            self._notifier.setEnabled(False)
+        if self.loop.is_closed():
+            return
+        all_tasks = getattr(asyncio, 'all_tasks', None) or \
+            asyncio.Task.all_tasks
+        tasks = [t for t in all_tasks(self.loop) if not t.done()]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            self.loop.run_until_complete(
+                asyncio.gather(*tasks, return_exceptions=True))
+        if hasattr(self.loop, 'shutdown_asyncgens'):
+            self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+        self.loop.close()
+
+
+_driver = None
+
+
+def get_event_loop():
+    """Return the asyncio event loop run by Qt, creating it if needed.
+
+    Must be called on the GUI thread. The loop is closed when the
+    application quits.
+    """
+    global _driver
+    if _driver is None or _driver.loop.is_closed():
+        app = QtCore.QCoreApplication.instance()
+        _driver = QtEventLoopDriver(parent=app)
+        app.aboutToQuit.connect(_driver.close)
+    return _driver.loop
+
+
+def run_job(worker, future, coroutine):
+    """Run the coroutine of a job as a task, completing its future.
+
+    Cancelling the future while the job runs cancels the task.
+    """
+    if not future._start():
+        coroutine.close()
+        return
+    future._started_at = _timer()
+    loop = get_event_loop()
+    task = loop.create_task(coroutine)
+    task.add_done_callback(lambda task: _task_done(worker, future, task))
+    future._set_interrupt(partial(loop.call_soon_threadsafe, task.cancel))
+
+
+def _task_done(worker, future, task):
+    if task.cancelled():
+        future._set_cancelled()
+    else:
+        error = task.exception()
+        future._set(None if error is not None else task.result(), error)
+    worker.metrics.job_done(future._name,
+                            future._started_at - future._queued_at,
+                            future._finished_at - future._started_at)
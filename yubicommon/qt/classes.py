@@ -89,7 +89,7 @@ class _MainWindow(QtGui.QMainWindow):
 class Application(QtGui.QApplication):
     _quit = False
 
-    def __init__(self, m=None, version=None):
+    def __init__(self, m=None, version=None, max_workers=None):
         super(Application, self).__init__(sys.argv)
         self._determine_basedir()
         self._read_package_version(version)
@@ -102,7 +102,13 @@ class Application(QtGui.QApplication):
                         not key.startswith('_')):
                     setattr(m, key, self.tr(getattr(m, key)))
 
-        self.worker = Worker(self.window, m)
+        self.worker = Worker(self.window, m, max_workers)
+
+    @property
+    def event_loop(self):
+        """The asyncio event loop run by exec_, Python 3.5 or later only."""
+        from .aio import get_event_loop
+        return get_event_loop()
 
     def event(self, event):
         if sys.platform == "darwin" and event.type() \
@@ -161,9 +167,7 @@ class Application(QtGui.QApplication):
         self._quit = True
 
     def _stop(self):
-        worker_thread = self.worker.thread()
-        worker_thread.quit()
-        worker_thread.wait()
+        self.worker.stop()
         self.deleteLater()
         sys.stdout.flush()
         sys.stderr.flush()
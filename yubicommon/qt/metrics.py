@@ -0,0 +1,146 @@
+# Copyright (c) 2014 Yubico AB
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Additional permission under GNU GPL version 3 section 7
+#
+# If you modify this program, or any covered work, by linking or
+# combining it with the OpenSSL project's OpenSSL library (or a
+# modified version of that library), containing parts covered by the
+# terms of the OpenSSL or SSLeay licenses, We grant you additional
+# permission to convey the resulting work. Corresponding Source for a
+# non-source form of such a combination shall include the source code
+# for the parts of OpenSSL used as well as that of the covered work.
+
+from __future__ import absolute_import
+
+from bisect import bisect_left
+from ..stats import StatsCollector
+import logging
+import threading
+
+__all__ = ['Histogram', 'WorkerMetrics']
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram(object):
+    """Histogram of durations in seconds, with fixed logarithmic buckets."""
+
+    BOUNDS = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05,
+              0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        self.buckets[bisect_left(self.BOUNDS, value)] += 1
+
+    def percentile(self, fraction):
+        """Return the upper bound of the bucket holding the percentile."""
+        target = self.count * fraction
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= target:
+                return self.BOUNDS[i] if i < len(self.BOUNDS) else self.max
+        return 0.0
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else 0.0,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'buckets': dict(
+                ('le_%g' % b if i < len(self.BOUNDS) else 'inf', n)
+                for i, (b, n) in enumerate(zip(self.BOUNDS + (None,),
+                                               self.buckets)) if n)
+        }
+
+
+class WorkerMetrics(StatsCollector):
+    """Queue depth and per job timings of a Worker.
+
+    For each job name, histograms are kept of the time spent waiting in the
+    queue, running, and waiting for the callbacks to be delivered on the GUI
+    thread. Jobs running longer than slow_threshold seconds are logged.
+    Times are in seconds. Hooks are called with (name, wait_time, run_time)
+    from the thread that ran each job, and can be used to export the
+    timings, for instance to a log.
+    """
+
+    def __init__(self, slow_threshold=None):
+        super(WorkerMetrics, self).__init__()
+        self.slow_threshold = slow_threshold
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self._lock = threading.Lock()
+        self._jobs = {}
+
+    def _histograms(self, name):
+        histograms = self._jobs.get(name)
+        if histograms is None:
+            histograms = self._jobs[name] = {
+                'wait': Histogram(),
+                'run': Histogram(),
+                'dispatch': Histogram()
+            }
+        return histograms
+
+    def set_queue_depth(self, depth):
+        self.queue_depth = depth
+        if depth > self.max_queue_depth:
+            self.max_queue_depth = depth
+
+    def job_done(self, name, wait, run):
+        with self._lock:
+            histograms = self._histograms(name)
+            histograms['wait'].add(wait)
+            histograms['run'].add(run)
+        if self.slow_threshold is not None and run > self.slow_threshold:
+            logger.warning('Slow job %s: ran for %.3f s after waiting %.3f s',
+                           name, run, wait)
+        self._call_hooks(name, wait, run)
+
+    def dispatched(self, name, latency):
+        with self._lock:
+            self._histograms(name)['dispatch'].add(latency)
+
+    def reset(self):
+        with self._lock:
+            self._jobs = {}
+            self.max_queue_depth = self.queue_depth
+
+    def stats(self):
+        """Return the queue depth and per job statistics as a dict."""
+        with self._lock:
+            return {
+                'queue_depth': self.queue_depth,
+                'max_queue_depth': self.max_queue_depth,
+                'jobs': dict((name, dict((k, h.to_dict())
+                                         for k, h in histograms.items()))
+                             for name, histograms in self._jobs.items())
+            }
@@ -25,7 +25,7 @@
 # for the parts of OpenSSL used as well as that of the covered work.
 
 import ctypes
-from ..ctypes import CLibrary
+from ..ctypes import CLibrary, LAZY
 
 __all__ = ['app_services']
 
@@ -36,6 +36,8 @@ class ProcessSerialNumber(ctypes.Structure):
 
 
 class ApplicationServices(CLibrary):
+    _binding = LAZY
+
     ShowHideProcess = \
         [ctypes.POINTER(ProcessSerialNumber), ctypes.c_bool], None
     GetFrontProcess = [ctypes.POINTER(ProcessSerialNumber)], None
@@ -27,9 +27,21 @@
 from __future__ import absolute_import
 
 from PySide import QtCore
-from collections import MutableMapping
+from contextlib import contextmanager
+from .. import compat
+import atexit
+import os
+import threading
+import types
+import weakref
 
-__all__ = ['Settings', 'PySettings', 'convert_to']
+try:
+    from collections.abc import Mapping, MutableMapping
+except ImportError:  # Python 2
+    from collections import Mapping, MutableMapping
+
+__all__ = ['Settings', 'PySettings', 'CachedPySettings', 'SchemaSettings',
+           'Setting', 'convert_to']
 
 
 def convert_to(value, target_type):
@@ -44,55 +56,245 @@ def convert_to(value, target_type):
     return value
 
 
+def _group_scoped(fn):
+    def wrapped(self, *args, **kwargs):
+        self._mutex.lock()
+        try:
+            if self._depth:  # In a transaction, already in the group.
+                return fn(self._settings, *args, **kwargs)
+            self._check_transaction()
+            self._settings.beginGroup(self._group)
+            try:
+                return fn(self._settings, *args, **kwargs)
+            finally:
+                self._settings.endGroup()
+        finally:
+            self._mutex.unlock()
+    wrapped.__name__ = fn.__name__
+    return wrapped
+
+
 class SettingsGroup(object):
+    """Methods of a QSettings, scoped to a group and guarded by a mutex.
+
+    Operations on other groups of the same QSettings can't be made inside
+    a transaction, and raise RuntimeError.
+    """
+
+    # Wrappers of QSettings methods, keyed on (QSettings class, name).
+    _wrappers = {}
+    # Group in a transaction, keyed on id of the QSettings. Only accessed
+    # holding the mutex of the QSettings.
+    _transactions = {}
 
     def __init__(self, settings, mutex, group):
         self._settings = settings
         self._mutex = mutex
         self._group = group
+        self._depth = 0
 
     def __getattr__(self, method_name):
-        if hasattr(self._settings, method_name):
-            fn = getattr(self._settings, method_name)
-
-            def wrapped(*args, **kwargs):
-                try:
-                    self._mutex.lock()
+        if method_name.startswith('__'):
+            raise AttributeError(method_name)
+        cls = type(self._settings)
+        wrapper = self._wrappers.get((cls, method_name))
+        if wrapper is None:
+            fn = getattr(cls, method_name)
+            if not callable(fn) or isinstance(fn, type):
+                return getattr(self._settings, method_name)
+            wrapper = self._wrappers[(cls, method_name)] = _group_scoped(fn)
+        method = types.MethodType(wrapper, self)
+        setattr(self, method_name, method)
+        return method
+
+    @contextmanager
+    def transaction(self):
+        """Lock and enter the group once, for a sequence of operations.
+
+        With a backend from yubicommon.settings_backends, the operations are
+        also saved together, see SettingsBackend.beginTransaction.
+        """
+        self._mutex.lock()
+        try:
+            if not self._depth:
+                self._check_transaction()
+            batch = not self._depth and \
+                hasattr(self._settings, 'beginTransaction')
+            if batch:
+                self._settings.beginTransaction()
+            try:
+                if not self._depth:
                     self._settings.beginGroup(self._group)
-                    return fn(*args, **kwargs)
+                    self._transactions[id(self._settings)] = self
+                self._depth += 1
+                try:
+                    yield self
                 finally:
-                    self._settings.endGroup()
-                    self._mutex.unlock()
-            return wrapped
+                    self._depth -= 1
+                    if not self._depth:
+                        del self._transactions[id(self._settings)]
+                        self._settings.endGroup()
+            finally:
+                if batch:
+                    self._settings.endTransaction()
+        finally:
+            self._mutex.unlock()
+
+    def _check_transaction(self):
+        active = self._transactions.get(id(self._settings))
+        if active is not None:
+            raise RuntimeError('Can\'t use group %s in a transaction of %s'
+                               % (self._group, active._group))
+
+    def get_many(self, keys):
+        """Return a dict of the values of those keys which are set."""
+        with self.transaction():
+            settings = self._settings
+            return dict((key, settings.value(key)) for key in keys
+                        if settings.contains(key))
+
+    def set_many(self, data):
+        with self.transaction():
+            for key, value in data.items():
+                self._settings.setValue(key, value)
+
+    def snapshot(self):
+        """Return a dict of all values in the group."""
+        with self.transaction():
+            settings = self._settings
+            return dict((key, settings.value(key))
+                        for key in settings.childKeys())
 
     def rename(self, new_name):
-        data = dict((key, self.value(key)) for key in self.childKeys())
-        self.remove('')
-        self._group = new_name
-        for k, v in data.items():
-            self.setValue(k, v)
+        self._mutex.lock()
+        try:
+            with self.transaction():
+                data = self.snapshot()
+                self._settings.remove('')
+            self._group = new_name
+            self.set_many(data)
+        finally:
+            self._mutex.unlock()
 
     def __repr__(self):
         return 'Group(%s)' % self._group
 
 
 class Settings(QtCore.QObject):
+    """Thread safe access to groups of a QSettings.
+
+    Instead of a QSettings, a backend from yubicommon.settings_backends can
+    be used, storing the settings in SQLite or JSON.
+
+    Given cache=True, groups are returned as CachedPySettings, shared by all
+    users of the same group, and writes are saved at most sync_delay
+    seconds after they are made. Cached values are reloaded when the
+    settings file is changed by another process. The file is watched from
+    the thread the Settings is created on, which must run an event loop.
+    """
+    _watch_requested = QtCore.Signal()
 
-    def __init__(self, q_settings, wrap=True):
+    def __init__(self, q_settings, wrap=True, cache=False, sync_delay=1.0):
         super(Settings, self).__init__()
         self._mutex = QtCore.QMutex(QtCore.QMutex.Recursive)
         self._wrap = wrap
         self._q_settings = q_settings
-
-    def get_group(self, group):
+        self._cache = cache
+        self._sync_delay = sync_delay
+        self._cached = weakref.WeakValueDictionary()
+        self._watcher = None
+        # Stat of the watched files when last written or reloaded by us.
+        self._stamp = None
+        if cache and wrap:
+            self._watcher = QtCore.QFileSystemWatcher(self)
+            self._watcher.fileChanged.connect(self._file_changed)
+            # Catches the file being created, or replaced by a rename.
+            self._watcher.directoryChanged.connect(self._file_changed)
+            # Groups may be created on other threads.
+            self._watch_requested.connect(self._watch)
+            self._stamp = self._get_stamp()
+            self._watch()
+
+    def get_group(self, group, cls=None):
+        """Return a group, wrapped in cls instead of PySettings if given."""
+        if cls is not None:
+            return cls(SettingsGroup(self._q_settings, self._mutex, group))
+        if self._cache and self._wrap:
+            g = self._cached.get(group)
+            if g is None:
+                g = self._cached[group] = CachedPySettings(
+                    SettingsGroup(self._q_settings, self._mutex, group),
+                    self._sync_delay, self._cached, self._sync_file)
+                self._watch_requested.emit()
+            return g
         g = SettingsGroup(self._q_settings, self._mutex, group)
         if self._wrap:
             g = PySettings(g)
         return g
 
+    def _watched_files(self):
+        watched_files = getattr(self._q_settings, 'watchedFiles', None)
+        if watched_files is not None:
+            return watched_files()
+        return [self._q_settings.fileName()]
+
+    def _get_stamp(self):
+        stamp = []
+        for path in self._watched_files():
+            try:
+                st = os.stat(path)
+                stamp.append((st.st_mtime, st.st_size, st.st_ino))
+            except OSError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    @QtCore.Slot()
+    def _watch(self):
+        for path in self._watched_files():
+            directory = os.path.dirname(path)
+            if os.path.isdir(directory) and \
+                    directory not in self._watcher.directories():
+                self._watcher.addPath(directory)
+            if os.path.isfile(path) and path not in self._watcher.files():
+                self._watcher.addPath(path)
+
+    def _file_changed(self, path):
+        self._watch()  # The file may have been replaced, watch the new one.
+        if self._get_stamp() != self._stamp:  # Not by our own sync.
+            self._sync_file()
+
+    def _sync_file(self):
+        """Sync the QSettings, reloading cached groups if others changed it.
+
+        Changes are detected by comparing the watched files to how they
+        were after the previous sync, so that our own writes are ignored.
+        """
+        self._mutex.lock()
+        try:
+            changed = self._get_stamp() != self._stamp
+            self._q_settings.sync()
+            self._stamp = self._get_stamp()
+            if changed:
+                # Tells the writes of other processes from our own.
+                has_changes = getattr(self._q_settings, 'hasExternalChanges',
+                                      None)
+                changed = has_changes is None or has_changes()
+        finally:
+            self._mutex.unlock()
+        if changed:
+            for group in list(self._cached.values()):
+                group.invalidate()
+
+    def sync(self):
+        """Save pending writes of cached groups, and reload changes."""
+        for group in list(self._cached.values()):
+            group.sync()
+        self._sync_file()
+
     @staticmethod
     def wrap(*args, **kwargs):
-        return Settings(QtCore.QSettings(*args, **kwargs))
+        cache = kwargs.pop('cache', False)
+        return Settings(QtCore.QSettings(*args, **kwargs), cache=cache)
 
 
 class PySettings(MutableMapping):
@@ -109,6 +311,40 @@ class PySettings(MutableMapping):
             val = convert_to(val, type(default))
         return val
 
+    def get_many(self, keys, default=None):
+        """Return a dict of values, converted as for get.
+
+        keys is either a list of keys sharing the same default, or a dict
+        mapping each key to its default.
+        """
+        if isinstance(keys, Mapping):
+            defaults = keys
+        else:
+            defaults = dict.fromkeys(keys, default)
+        values = self._settings.get_many(defaults)
+        result = {}
+        for key, default in defaults.items():
+            val = values.get(key, default)
+            if not isinstance(val, type(default)):
+                val = convert_to(val, type(default))
+            result[key] = val
+        return result
+
+    def set_many(self, data):
+        self._settings.set_many(data)
+
+    def snapshot(self):
+        """Return a dict of all values, unconverted."""
+        return self._settings.snapshot()
+
+    def items(self):
+        return [(key, self._convert(key, value))
+                for key, value in self.snapshot().items()]
+
+    def _convert(self, key, value):
+        """Return a stored value as self[key] would."""
+        return value
+
     def __getitem__(self, key):
         return self.get(key)
 
@@ -132,11 +368,335 @@ class PySettings(MutableMapping):
         return self._settings.childKeys()
 
     def update(self, data):
-        for key, value in list(data.items()):
-            self[key] = value
+        self.set_many(dict(data))
 
     def clear(self):
         self._settings.remove('')
 
     def __repr__(self):
         return 'PySettings(%s)' % self._settings
+
+
+_DELETED = object()  # Pending removal, of the whole group for key ''.
+
+
+def _apply_changes(values, changes):
+    if changes.get('') is _DELETED:
+        values.clear()
+    for key, value in changes.items():
+        if value is _DELETED:
+            values.pop(key, None)
+        else:
+            values[key] = value
+
+_unsynced = weakref.WeakValueDictionary()  # Keyed on id, as unhashable.
+
+
+@atexit.register
+def _sync_all():
+    for settings in list(_unsynced.values()):
+        settings.sync()
+
+
+class CachedPySettings(PySettings):
+    """PySettings reading from an in-memory copy of its group.
+
+    Reads don't lock or touch the QSettings, and converted values are kept
+    per type of default. Writes update the copy immediately, and are saved
+    by sync(), which is called sync_delay seconds after the first unsaved
+    write, or at exit. Only the mapping methods use the copy, other methods
+    of the QSettings are passed through as for PySettings.
+    """
+
+    def __init__(self, settings, sync_delay=1.0, registry=None,
+                 sync_settings=None):
+        super(CachedPySettings, self).__init__(settings)
+        self._sync_delay = sync_delay
+        self._registry = registry
+        # Saves the QSettings after pending writes are made to it.
+        self._sync_settings = sync_settings or settings.sync
+        self._lock = threading.Lock()
+        self._snapshot = None  # (values, converted values) or None.
+        self._pending = {}
+        self._timer = None
+        # Changed whenever the QSettings may have been written, so that
+        # values read before that are discarded.
+        self._generation = 0
+
+    def _get_snapshot(self):
+        snapshot = self._snapshot
+        while snapshot is None:
+            # The QSettings is read without holding the lock, as callers
+            # may take the lock while holding the QSettings mutex.
+            generation = self._generation
+            values = self._settings.snapshot()
+            with self._lock:
+                if generation != self._generation:
+                    continue
+                _apply_changes(values, self._pending)
+                snapshot = self._snapshot = (values, {})
+        return snapshot
+
+    def invalidate(self):
+        """Drop the cached values, reloading them on next access."""
+        with self._lock:
+            self._generation += 1
+            self._snapshot = None
+
+    def get(self, key, default=None):
+        values, converted = self._get_snapshot()
+        if key not in values:
+            return default
+        typed_key = (key, type(default))
+        try:
+            val = converted[typed_key]
+        except KeyError:
+            val = values[key]
+            if not isinstance(val, type(default)):
+                val = convert_to(val, type(default))
+            converted[typed_key] = val
+        return list(val) if isinstance(val, list) else val
+
+    def get_many(self, keys, default=None):
+        if isinstance(keys, Mapping):
+            return dict((key, self.get(key, d)) for key, d in keys.items())
+        return dict((key, self.get(key, default)) for key in keys)
+
+    def snapshot(self):
+        return dict(self._get_snapshot()[0])
+
+    def _write(self, data):
+        with self._lock:
+            if self._snapshot is not None:
+                values = dict(self._snapshot[0])
+                _apply_changes(values, data)
+                self._snapshot = (values, {})
+            if data.get('') is _DELETED:
+                self._pending.clear()  # Made moot by clearing the group.
+            self._pending.update(data)
+            if self._timer is None:
+                self._timer = threading.Timer(self._sync_delay, self.sync)
+                self._timer.daemon = True
+                self._timer.start()
+                _unsynced[id(self)] = self
+
+    def __setitem__(self, key, value):
+        self._write({key: value})
+
+    def __delitem__(self, key):
+        self._write({key: _DELETED})
+
+    def set_many(self, data):
+        self._write(dict(data))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._get_snapshot()[0])
+
+    def __contains__(self, key):
+        return key in self._get_snapshot()[0]
+
+    def keys(self):
+        return list(self._get_snapshot()[0])
+
+    def clear(self):
+        """Remove all values of the group, and its subgroups."""
+        self._write({'': _DELETED})
+
+    def _convert(self, key, value):
+        return list(value) if isinstance(value, list) else value
+
+    def rename(self, new_name):
+        self.sync()
+        old_name = self._settings._group
+        self._settings.rename(new_name)
+        if self._registry is not None:
+            if self._registry.get(old_name) is self:
+                del self._registry[old_name]
+            self._registry[new_name] = self
+
+    def sync(self):
+        """Save pending writes to the QSettings."""
+        with self._lock:
+            pending = dict(self._pending)
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            _unsynced.pop(id(self), None)
+        with self._settings.transaction():
+            if pending.get('') is _DELETED:
+                self._settings.remove('')  # Before any later writes.
+            for key, value in pending.items():
+                if not key:
+                    continue
+                if value is _DELETED:
+                    self._settings.remove(key)
+                else:
+                    self._settings.setValue(key, value)
+        with self._lock:
+            self._generation += 1
+            # Keep writes made meanwhile, they have a timer of their own.
+            for key, value in pending.items():
+                if self._pending.get(key, _DELETED) is value:
+                    self._pending.pop(key, None)
+        if pending:
+            self._sync_settings()
+
+    def __repr__(self):
+        return 'CachedPySettings(%s)' % self._settings
+
+
+_FALSE = ('', 'false', 'False')
+
+
+def _compile_converter(target_type):
+    """Return a function converting values to a type, as get does."""
+    if target_type is bool:
+        def convert(value):
+            return value if isinstance(value, bool) else value not in _FALSE
+    elif target_type is int:
+        def convert(value):
+            if isinstance(value, int):
+                return value
+            return 0 if value in _FALSE else int(value)
+    elif target_type is float:
+        def convert(value):
+            return value if isinstance(value, float) else float(value)
+    elif target_type is list:
+        def convert(value):
+            if isinstance(value, list):
+                return value
+            return [] if value is None else [value]
+    else:
+        def convert(value):
+            return value
+    return convert
+
+
+class Setting(object):
+    """A typed setting, declared as a class attribute of SchemaSettings.
+
+    The value is stored under key, by default the attribute name. The
+    validator is called with converted values, and returns False (or
+    raises ValueError) for invalid ones.
+    """
+
+    def __init__(self, type_, default=None, validator=None, key=None):
+        self.type = type_
+        self.default = type_() if default is None else default
+        self.validator = validator
+        self.key = key
+        self.convert = _compile_converter(type_)
+
+    def read(self, settings):
+        return self.from_stored(settings.value(self.key))
+
+    def from_stored(self, val):
+        """Return the value of the setting, given its stored value or None."""
+        if val is None:
+            val = self.default
+        else:
+            val = self.convert(val)
+        return list(val) if isinstance(val, list) else val
+
+    def check(self, value):
+        """Convert and validate a value, raising ValueError if invalid."""
+        try:
+            value = self.convert(value)
+        except (TypeError, ValueError):
+            raise ValueError('Invalid value for %s: %r' % (self.key, value))
+        if self.validator is not None and not self.validator(value):
+            raise ValueError('Invalid value for %s: %r' % (self.key, value))
+        return value
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        return self.read(obj._settings)
+
+    def __set__(self, obj, value):
+        obj[self.key] = value
+
+    def __delete__(self, obj):
+        del obj[self.key]
+
+
+class _SchemaMeta(type(PySettings)):
+
+    def __init__(cls, name, bases, attrs):
+        super(_SchemaMeta, cls).__init__(name, bases, attrs)
+        schema = {}
+        for base in reversed(cls.__mro__[1:]):
+            schema.update(getattr(base, '_schema', {}))
+        for attr, value in attrs.items():
+            if isinstance(value, Setting):
+                if value.key is None:
+                    value.key = attr
+                schema[value.key] = value
+        cls._schema = schema
+
+
+class SchemaSettings(compat.with_metaclass(_SchemaMeta, PySettings)):
+    """PySettings with typed settings declared as class attributes.
+
+    Example:
+        class AppSettings(SchemaSettings):
+            timeout = Setting(int, 30, lambda v: v > 0)
+            mode = Setting(str, 'otp')
+
+        app_settings = settings.get_group('app', AppSettings)
+        app_settings.timeout += 10
+
+    Declared settings are read with a converter compiled for their type,
+    both as attributes and by key, and are validated when written.
+    """
+
+    def get(self, key, default=None):
+        setting = self._schema.get(key)
+        if setting is None or default is not None:
+            return super(SchemaSettings, self).get(key, default)
+        return setting.read(self._settings)
+
+    def _convert(self, key, value):
+        setting = self._schema.get(key)
+        if setting is None:
+            return super(SchemaSettings, self)._convert(key, value)
+        return setting.from_stored(value)
+
+    def __setitem__(self, key, value):
+        setting = self._schema.get(key)
+        if setting is not None:
+            value = setting.check(value)
+        super(SchemaSettings, self).__setitem__(key, value)
+
+    def set_many(self, data):
+        data = dict(data)
+        for key, value in data.items():
+            if key in self._schema:
+                data[key] = self._schema[key].check(value)
+        super(SchemaSettings, self).set_many(data)
+
+    def validate(self, fix=False):
+        """Check all stored values against the schema in one pass.
+
+        Returns a dict mapping the keys of invalid values to error messages.
+        Given fix, invalid values are removed so that defaults apply.
+        """
+        values = self.snapshot()
+        errors = {}
+        for key, setting in self._schema.items():
+            if key in values:
+                try:
+                    setting.check(values[key])
+                except ValueError as e:
+                    errors[key] = str(e)
+        if fix and errors:
+            with self._settings.transaction():
+                for key in errors:
+                    self._settings.remove(key)
+        return errors
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, self._settings)
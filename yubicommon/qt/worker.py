@@ -27,11 +27,24 @@
 from __future__ import absolute_import
 
 from PySide import QtGui, QtCore
+from collections import deque, namedtuple
 from functools import partial
+from heapq import heappush, heappop
+from itertools import count
 from os import getenv
-from .utils import connect_once, get_active_window, default_messages
+from .metrics import WorkerMetrics
+from ..stats import timer as _timer
+from .utils import get_active_window, default_messages
+from types import GeneratorType
+import inspect
+import multiprocessing
+import pickle
+import threading
 import traceback
 
+# Jobs running longer than this many seconds are logged when DEBUG is set.
+SLOW_JOB_THRESHOLD = 0.5
+
 
 class _Messages(object):
     wait = 'Please wait...'
@@ -49,55 +62,636 @@ class _Event(QtCore.QEvent):
         del self._callback
 
 
+class _Dispatcher(object):
+    """Delivers callbacks to the GUI thread in batches.
+
+    Callbacks are collected in a deque and a single event is posted to wake
+    up the GUI thread while any are pending. The GUI thread then runs them
+    until none remain or the time budget (in seconds) is used up, in which
+    case it posts another event so that repaints get processed in between.
+    """
+
+    def __init__(self, window, budget):
+        self.window = window
+        self.budget = budget
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._posted = False
+
+    def dispatch(self, fn):
+        with self._lock:
+            self._pending.append(fn)
+            if self._posted:
+                return
+            self._posted = True
+        self._wake()
+
+    def _wake(self):
+        QtGui.QApplication.postEvent(self.window, _Event(self._drain))
+
+    def _drain(self):
+        deadline = _timer() + self.budget
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._posted = False
+                    return
+                fn = self._pending.popleft()
+            try:
+                fn()
+            except:
+                self._wake()  # Keep draining after the error is reported.
+                raise
+            if _timer() > deadline:
+                self._wake()
+                return
+
+
+_PENDING, _RUNNING, _FINISHED, _CANCELLED = range(4)
+
+# Minimum time in seconds between updates sent by a generator job.
+STREAM_INTERVAL = 0.1
+
+Progress = namedtuple('Progress', ['value', 'maximum'])
+
+_current = threading.local()
+
+
+def current_job():
+    """Return the JobFuture of the job running in this thread, if any."""
+    return getattr(_current, 'job', None)
+
+
+class JobCancelled(Exception):
+    """Raised when getting the result of a cancelled job."""
+
+
+class JobFuture(object):
+    """Handle to a job posted to a Worker.
+
+    A job which is still queued can be cancelled. A running job isn't
+    interrupted by cancel(), but can check current_job().cancel_requested()
+    to stop early. Running coroutine jobs are cancelled like asyncio tasks.
+    Callbacks added with add_done_callback are called with the future on the
+    GUI thread once the job has finished or is cancelled.
+
+    Errors raised by the job are re-raised on the GUI thread, as they were
+    before futures, unless return_errors was given or the future has done
+    callbacks to handle them.
+    """
+
+    def __init__(self, worker, fn, callback=None, return_errors=False,
+                 done=None, on_items=None, on_progress=None):
+        self._worker = worker
+        self._fn = fn
+        self._callback = callback
+        self._return_errors = return_errors
+        self._done = done
+        self._on_items = on_items
+        self._on_progress = on_progress
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._state = _PENDING
+        self._cancel_requested = False
+        self._interrupt = None
+        self._result = None
+        self._exception = None
+        self._done_callbacks = []
+        self._name = None
+        self._queued_at = None
+        self._started_at = None
+        self._finished_at = None
+
+    def cancel(self):
+        """Cancel the job, returns False if it is already running or done.
+
+        A running job is asked to stop, see cancel_requested. The task of a
+        running coroutine job is cancelled, cancelling the job once it ends.
+        """
+        with self._lock:
+            self._cancel_requested = True
+            state, interrupt = self._state, self._interrupt
+            if state == _PENDING:
+                self._state = _CANCELLED
+        if state != _PENDING:
+            if state == _RUNNING and interrupt is not None:
+                interrupt()
+            return state == _CANCELLED
+        self._complete()
+        return True
+
+    def cancel_requested(self):
+        return self._cancel_requested
+
+    def cancelled(self):
+        return self._state == _CANCELLED
+
+    def running(self):
+        return self._state == _RUNNING
+
+    def done(self):
+        return self._state in (_FINISHED, _CANCELLED)
+
+    def result(self, timeout=None):
+        """Wait for the job to finish and return its result.
+
+        Raises the error of the job, or JobCancelled. Don't wait on the GUI
+        thread for a job posted with post_fg, or for a coroutine job, as
+        these run on the GUI thread and waiting would deadlock.
+        """
+        self._wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """Wait for the job to finish and return its error, if any."""
+        self._wait(timeout)
+        return self._exception
+
+    def _wait(self, timeout):
+        if not self._event.wait(timeout):
+            raise RuntimeError('Timed out waiting for job')
+        if self._state == _CANCELLED:
+            raise JobCancelled()
+
+    def add_done_callback(self, fn):
+        """Call fn(future) on the GUI thread once the job is done."""
+        with self._lock:
+            if not self.done():
+                self._done_callbacks.append(fn)
+                return
+        self._worker._dispatch(partial(fn, self))
+
+    def then(self, fn, callback=None, return_errors=False, priority=0):
+        """Run fn(result) as a new background job once this job succeeds.
+
+        Returns a JobFuture for the new job. If this job fails or is
+        cancelled, so is the new one.
+        """
+        chained = JobFuture(self._worker, None, callback, return_errors)
+
+        def start(future):
+            if future.cancelled():
+                chained.cancel()
+            elif future._exception is not None:
+                chained._start()
+                chained._set(None, future._exception)
+            else:
+                chained._fn = partial(fn, future._result)
+                self._worker._submit(chained, priority)
+        self.add_done_callback(start)
+        return chained
+
+    def _start(self):
+        with self._lock:
+            if self._state != _PENDING:
+                return False
+            self._state = _RUNNING
+            return True
+
+    def _set_interrupt(self, interrupt):
+        """Set a function to call if the running job is cancelled."""
+        with self._lock:
+            self._interrupt = interrupt
+            requested = self._cancel_requested
+        if requested:
+            interrupt()
+
+    def _run(self):
+        try:
+            result = self._fn()
+            if isinstance(result, GeneratorType):
+                result = self._stream(result)
+        except Exception as e:
+            if getenv('DEBUG'):
+                traceback.print_exc()
+            self._set(None, e)
+        else:
+            self._set(result, None)
+
+    def _stream(self, generator):
+        """Run a generator job, streaming its output to the GUI thread.
+
+        Progress items update the progress, other items are collected and
+        passed to on_items in batches, at most once per STREAM_INTERVAL.
+        The result of the job is the list of all collected items.
+        """
+        items = []
+        batch = []
+        progress = None
+        next_flush = _timer() + STREAM_INTERVAL
+        try:
+            for item in generator:
+                if isinstance(item, Progress):
+                    progress = item
+                else:
+                    items.append(item)
+                    batch.append(item)
+                if _timer() >= next_flush:
+                    self._flush(batch, progress)
+                    batch, progress = [], None
+                    next_flush = _timer() + STREAM_INTERVAL
+                if self._cancel_requested:
+                    break
+        finally:
+            generator.close()
+        self._flush(batch, progress)
+        return items
+
+    def _flush(self, batch, progress):
+        if batch and self._on_items:
+            self._worker._dispatch(partial(self._on_items, batch))
+        if progress is not None and self._on_progress:
+            self._worker._dispatch(partial(self._on_progress, *progress))
+
+    def _set(self, result, exception):
+        self._finished_at = _timer()
+        with self._lock:
+            self._result = result
+            self._exception = exception
+            self._state = _FINISHED
+        self._complete()
+
+    def _set_cancelled(self):
+        self._finished_at = _timer()
+        with self._lock:
+            self._state = _CANCELLED
+        self._complete()
+
+    def _complete(self):
+        self._fn = None
+        self._interrupt = None
+        self._event.set()
+        with self._lock:
+            callbacks, self._done_callbacks = self._done_callbacks, []
+        raise_error = self._exception is not None and \
+            not self._return_errors
+        if callbacks or self._callback or self._done or raise_error:
+            self._worker._dispatch(partial(self._finish, callbacks))
+
+    def _finish(self, callbacks):
+        if self._started_at is not None:
+            self._worker.metrics.dispatched(
+                self._name, _timer() - self._finished_at)
+        try:
+            if self._state == _FINISHED:
+                if self._exception is not None and not self._return_errors:
+                    if not callbacks:
+                        raise self._exception
+                elif self._callback:
+                    self._callback(self._result if self._exception is None
+                                   else self._exception)
+            for callback in callbacks:
+                callback(self)
+        finally:
+            self._callback = None
+            if self._done:
+                self._done()
+                self._done = None
+
+
+class _JobQueue(object):
+    """Thread safe priority queue of jobs, which can be coalesced by key.
+
+    Jobs with higher priority are taken first, jobs of equal priority in the
+    order they were put. Putting a job with the same key as a pending job
+    replaces that job, keeping its place in the queue.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._heap = []
+        self._keys = {}
+        self._counter = count()
+        self._size = 0
+
+    def put(self, job, priority=0, key=None):
+        """Add a job, returning the pending job it replaced, if any."""
+        replaced = None
+        with self._lock:
+            old = self._keys.get(key) if key is not None else None
+            # The third item only breaks ties between a replaced entry and
+            # its replacement, which share their place in the queue.
+            if old is None:
+                order = next(self._counter)
+                entry = [-priority, order, order, key, job]
+                self._size += 1
+            else:
+                entry = [min(old[0], -priority), old[1], next(self._counter),
+                         key, job]
+                replaced = old[4]
+                old[4] = None  # Removed lazily when popped.
+            heappush(self._heap, entry)
+            if key is not None:
+                self._keys[key] = entry
+        return replaced
+
+    def get(self):
+        """Remove and return the next job, or None if the queue is empty."""
+        with self._lock:
+            while self._heap:
+                entry = heappop(self._heap)
+                job = entry[4]
+                if job is not None:
+                    if entry[3] is not None:
+                        del self._keys[entry[3]]
+                    self._size -= 1
+                    return job
+        return None
+
+    def __len__(self):
+        return self._size
+
+
+class _Runnable(QtCore.QRunnable):
+
+    def __init__(self, worker):
+        super(_Runnable, self).__init__()
+        self._worker = worker
+
+    def run(self):
+        self._worker._work_next()
+
+
 class Worker(QtCore.QObject):
-    _work_signal = QtCore.Signal(tuple)
+    """Runs jobs in the background, delivering results on the GUI thread.
+
+    By default jobs run one at a time on a dedicated thread. Given
+    max_workers, jobs instead run on a thread pool of that size, so
+    independent jobs can run in parallel.
+
+    Jobs are queued by priority, higher priorities running first. Jobs
+    posted with a key replace any pending job with the same key, so that
+    repeated requests for the same work only run once.
+
+    post, post_bg and post_fg return a JobFuture, which can be used to
+    cancel the job, wait for it, or add further callbacks and jobs.
+
+    Callbacks are delivered to the GUI thread in batches, running for at
+    most callback_budget seconds before letting Qt process other events.
+
+    A job returning a generator is run to completion in the background,
+    yielding either results or Progress(value, maximum) tuples. Results are
+    streamed to on_items in batches, and progress updates the progress
+    dialog of post, or is passed to on_progress(value, maximum). The result
+    of such a job is the list of all yielded results.
+
+    On Python 3.5 or later, jobs can also be coroutines, or coroutine
+    functions. These run as tasks of the asyncio event loop driven by the
+    Qt event loop on the GUI thread (see yubicommon.qt.aio), so many I/O
+    bound jobs can run concurrently without a thread each. Such jobs are
+    started right away, ignoring priority and key.
+
+    CPU bound jobs can be run in a pool of processes with post_process, so
+    that they neither hold the GIL nor compete with the GUI thread.
+
+    Queue depth and timings of jobs are collected in metrics, a
+    WorkerMetrics. Jobs running longer than slow_threshold seconds are
+    logged, by default only when the DEBUG environment variable is set.
+    """
+    _work_signal = QtCore.Signal()
     _work_done_0 = QtCore.Signal()
 
     @default_messages(_Messages)
-    def __init__(self, window, m):
+    def __init__(self, window, m, max_workers=None, callback_budget=0.01,
+                 slow_threshold=None):
         super(Worker, self).__init__()
         self.m = m
         self.window = window
-        self._work_signal.connect(self.work)
-        self.work_thread = QtCore.QThread()
-        self.moveToThread(self.work_thread)
-        self.work_thread.start()
+        if slow_threshold is None and getenv('DEBUG'):
+            slow_threshold = SLOW_JOB_THRESHOLD
+        self.metrics = WorkerMetrics(slow_threshold)
+        self._queue = _JobQueue()
+        self._dispatcher = _Dispatcher(window, callback_budget)
+        self._processes = None
+        if max_workers:
+            self._pool = QtCore.QThreadPool()
+            self._pool.setMaxThreadCount(max_workers)
+        else:
+            self._pool = None
+            # Queued, so that jobs posting jobs don't run them nested.
+            self._work_signal.connect(self._work_next,
+                                      QtCore.Qt.QueuedConnection)
+            self.work_thread = QtCore.QThread()
+            self.moveToThread(self.work_thread)
+            self.work_thread.start()
 
-    def post(self, title, fn, callback=None, return_errors=False):
+    def post(self, title, fn, callback=None, return_errors=False,
+             priority=0, key=None, on_items=None):
         busy = QtGui.QProgressDialog(title, None, 0, 0, get_active_window())
+        # Progress is shown through the bar, as QProgressDialog.setValue
+        # processes events when the dialog is modal.
+        bar = QtGui.QProgressBar(busy)
+        bar.setRange(0, 0)
+        busy.setBar(bar)
         busy.setWindowTitle(self.m.wait)
         busy.setWindowModality(QtCore.Qt.WindowModal)
         busy.setMinimumDuration(0)
+        busy.setProperty(_BUSY, True)
         busy.setWindowFlags(
             busy.windowFlags() ^ QtCore.Qt.WindowContextHelpButtonHint)
         busy.show()
-        connect_once(self._work_done_0, busy.close)
-        self.post_bg(fn, callback, return_errors)
+        future = JobFuture(self, _to_callable(fn), callback, return_errors,
+                           partial(_close_dialog, busy), on_items,
+                           partial(_set_progress, bar))
+        # Submit from the event loop, so the dialog gets to paint before the
+        # job starts competing for the GIL.
+        QtCore.QTimer.singleShot(
+            0, partial(self._submit, future, priority, key))
+        return future
 
-    def post_bg(self, fn, callback=None, return_errors=False):
-        if isinstance(fn, tuple):
-            fn = partial(fn[0], *fn[1:])
-        self._work_signal.emit((fn, callback, return_errors))
+    def post_bg(self, fn, callback=None, return_errors=False, priority=0,
+                key=None, on_items=None, on_progress=None):
+        return self._submit(
+            JobFuture(self, _to_callable(fn), callback, return_errors,
+                      None, on_items, on_progress),
+            priority, key)
 
     def post_fg(self, fn):
-        if isinstance(fn, tuple):
-            fn = partial(fn[0], *fn[1:])
-        event = _Event(fn)
-        QtGui.QApplication.postEvent(self.window, event)
+        future = JobFuture(self, _to_callable(fn))
+        future._name = _job_name(future._fn)
+        future._queued_at = _timer()
+        self._dispatch(partial(self._work_fg, future))
+        return future
 
-    @QtCore.Slot(tuple)
-    def work(self, job):
-        QtCore.QThread.msleep(10)  # Needed to yield
-        (fn, callback, return_errors) = job
+    def post_process(self, fn, callback=None, return_errors=False):
+        """Run fn in a pool of processes, one per CPU core.
+
+        fn, its arguments when given as a tuple, and its result must all be
+        picklable. If they can't be pickled, the job fails right away. The
+        job can't be cancelled once posted. The callback is called on the
+        GUI thread, as for post_bg.
+
+        On Python 3.4 or later, the processes are started with the spawn
+        method, as forking a process running Qt threads isn't safe. They
+        import the main module of the application, which must thus only
+        start the application under if __name__ == '__main__'. Older
+        versions fork the processes on POSIX systems. Frozen applications
+        must call multiprocessing.freeze_support() first thing there.
+        """
+        future = JobFuture(self, _to_callable(fn), callback, return_errors)
+        future._name = _job_name(future._fn)
+        future._queued_at = future._started_at = _timer()
+        future._start()
         try:
-            result = fn()
+            pickle.dumps(future._fn)
         except Exception as e:
-            result = e
-            if getenv('DEBUG'):
-                traceback.print_exc()
-            if not return_errors:
-                def callback(e): raise e
-        if callback:
-            event = _Event(partial(callback, result))
-            QtGui.QApplication.postEvent(self.window, event)
+            self._process_done(future, None, e)
+            return future
+        if hasattr(multiprocessing, 'get_context'):
+            if self._processes is None:
+                self._processes = multiprocessing.get_context('spawn').Pool()
+            self._processes.apply_async(
+                future._fn, callback=partial(self._process_done, future),
+                error_callback=partial(self._process_done, future, None))
+        else:
+            if self._processes is None:
+                self._processes = multiprocessing.Pool()
+            # There is no error_callback, so the job must not fail to return.
+            self._processes.apply_async(
+                _call, (future._fn,),
+                callback=partial(self._process_pickled, future))
+        return future
+
+    def _process_pickled(self, future, outcome):
+        result, error = pickle.loads(outcome)
+        self._process_done(future, result, error)
+
+    def _process_done(self, future, result, error=None):
+        future._set(result, error)
+        # Time spent queued for a free process is counted as run time.
+        self.metrics.job_done(future._name, 0.0,
+                              future._finished_at - future._started_at)
+
+    def _submit(self, future, priority=0, key=None):
+        future._name = _job_name(future._fn)
+        future._queued_at = _timer()
+        coroutine = _as_coroutine(future._fn)
+        if coroutine is not None:
+            self._dispatch(partial(self._start_coroutine, future, coroutine))
+            return future
+        replaced = self._queue.put(future, priority, key)
+        self.metrics.set_queue_depth(len(self._queue))
+        if replaced is not None:
+            replaced.cancel()
+        elif self._pool is not None:
+            self._pool.start(_Runnable(self))
+        else:
+            self._work_signal.emit()
+        return future
+
+    def _start_coroutine(self, future, coroutine):
+        from .aio import run_job
+        run_job(self, future, coroutine)
+
+    def _dispatch(self, fn):
+        self._dispatcher.dispatch(fn)
+
+    def stop(self):
+        """Wait for running jobs to finish and stop the worker threads."""
+        if self._processes is not None:
+            self._processes.close()
+            self._processes.join()
+            self._processes = None
+        if self._pool is not None:
+            self._pool.waitForDone()
+        else:
+            self.work_thread.quit()
+            self.work_thread.wait()
+
+    @QtCore.Slot()
+    def _work_next(self):
+        job = self._queue.get()
+        self.metrics.set_queue_depth(len(self._queue))
+        if job is not None:
+            self.work(job)
+
+    def work(self, job):
+        if job._start():
+            previous = current_job()
+            _current.job = job
+            try:
+                self._run(job)
+            finally:
+                _current.job = previous
         self._work_done_0.emit()
+
+    def _work_fg(self, job):
+        if job._start():
+            self._run(job)
+
+    def _run(self, job):
+        job._started_at = _timer()
+        job._run()
+        self.metrics.job_done(job._name, job._started_at - job._queued_at,
+                              job._finished_at - job._started_at)
+
+
+_BUSY = '_yubicommon_busy'
+
+
+def _close_dialog(dialog):
+    """Close a busy dialog, deleting it once no open dialogs depend on it.
+
+    A dialog shown while another is open becomes its child, so deleting a
+    dialog is deferred until all of its children have been closed.
+    """
+    dialog.close()
+    while isinstance(dialog, QtGui.QProgressDialog) and \
+            dialog.property(_BUSY) and not dialog.isVisible():
+        if any(d.isVisible() for d in dialog.findChildren(QtGui.QDialog)):
+            break
+        parent = dialog.parentWidget()
+        dialog.setProperty(_BUSY, False)
+        dialog.deleteLater()
+        dialog = parent
+
+
+def _set_progress(bar, value, maximum):
+    bar.setRange(0, maximum)
+    bar.setValue(value)
+
+
+def _call(fn):
+    """Run a job in a process, returning its (result, error) pickled."""
+    try:
+        outcome = fn(), None
+    except Exception as e:
+        outcome = None, e
+    try:
+        return pickle.dumps(outcome, pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        error = outcome[1] or e
+        return pickle.dumps((None, RuntimeError(
+            'Job failed in %s: %s' % (_job_name(fn), error))))
+
+
+_iscoroutine = getattr(inspect, 'iscoroutine', lambda obj: False)
+_iscoroutinefunction = getattr(inspect, 'iscoroutinefunction',
+                               lambda obj: False)
+
+
+def _as_coroutine(fn):
+    """Return the coroutine to run for a job, or None if it isn't one."""
+    if _iscoroutine(fn):
+        return fn
+    func = fn
+    while isinstance(func, partial):
+        func = func.func
+    if _iscoroutinefunction(func):
+        return fn()
+    return None
+
+
+def _job_name(fn):
+    while isinstance(fn, partial):
+        fn = fn.func
+    return getattr(fn, '__qualname__', None) or \
+        getattr(fn, '__name__', None) or type(fn).__name__
+
+
+def _to_callable(fn):
+    if isinstance(fn, tuple):
+        return partial(fn[0], *fn[1:])
+    return fn
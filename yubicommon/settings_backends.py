@@ -0,0 +1,336 @@
+# Copyright (c) 2013 Yubico AB
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#    1. Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    2. Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Settings storage backends which can be used in place of a QSettings.
+
+The backends implement the part of the QSettings API used by
+yubicommon.qt.settings.Settings, so that they can be passed to it instead of
+a QSettings. They don't depend on Qt, so helper processes and command line
+tools can read and write the same settings without importing PySide:
+
+    settings = SqliteSettingsBackend('settings.db')
+    timeout = settings.value('app/timeout', 30)
+
+Values must be JSON serializable.
+"""
+
+from __future__ import absolute_import
+
+import atexit
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import weakref
+
+__all__ = ['SettingsBackend', 'JsonSettingsBackend', 'SqliteSettingsBackend']
+
+
+_MISSING = object()
+
+_replace = getattr(os, 'replace', os.rename)
+
+
+class SettingsBackend(object):
+    """Base class of settings backends, storing '/' separated keys.
+
+    Subclasses implement _get, _set, _remove and _keys on full keys. Like a
+    QSettings, the current group isn't thread local, so a backend shared
+    between threads must be used through Settings, which locks it.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._groups = []
+        self._lock = threading.RLock()
+
+    def fileName(self):
+        return self._path
+
+    def beginGroup(self, prefix):
+        self._groups.append(prefix.strip('/'))
+
+    def endGroup(self):
+        self._groups.pop()
+
+    def group(self):
+        return '/'.join(g for g in self._groups if g)
+
+    def _key(self, key):
+        return '/'.join(p for p in (self.group(), key.strip('/')) if p)
+
+    def _prefix(self):
+        group = self.group()
+        return group + '/' if group else ''
+
+    def value(self, key, defaultValue=None):
+        with self._lock:
+            val = self._get(self._key(key))
+        return defaultValue if val is _MISSING else val
+
+    def setValue(self, key, value):
+        with self._lock:
+            self._set(self._key(key), value)
+
+    def remove(self, key):
+        """Remove the key and any keys under it, or the group if empty."""
+        with self._lock:
+            self._remove(self._key(key))
+
+    def contains(self, key):
+        with self._lock:
+            return self._get(self._key(key)) is not _MISSING
+
+    def allKeys(self):
+        prefix = self._prefix()
+        with self._lock:
+            return sorted(k[len(prefix):] for k in self._keys(prefix))
+
+    def childKeys(self):
+        return [k for k in self.allKeys() if '/' not in k]
+
+    def childGroups(self):
+        return sorted(set(k.split('/', 1)[0] for k in self.allKeys()
+                          if '/' in k))
+
+    def sync(self):
+        pass
+
+    def beginTransaction(self):
+        """Start a batch of operations, saved together by endTransaction.
+
+        Batches may be nested, the outermost one saving the operations. The
+        backend is locked for other threads until the batch ends.
+        """
+        self._lock.acquire()
+
+    def endTransaction(self):
+        self._lock.release()
+
+    def watchedFiles(self):
+        """Return the files written when the settings are changed."""
+        return [self._path]
+
+    def hasExternalChanges(self):
+        """Return whether others may have changed settings since last called.
+        """
+        return True
+
+    def _get(self, key):
+        raise NotImplementedError()
+
+    def _set(self, key, value):
+        raise NotImplementedError()
+
+    def _remove(self, key):
+        raise NotImplementedError()
+
+    def _keys(self, prefix):
+        """Return all full keys starting with prefix."""
+        raise NotImplementedError()
+
+
+_unsynced = weakref.WeakValueDictionary()  # Keyed on id.
+
+
+@atexit.register
+def _sync_all():
+    for backend in list(_unsynced.values()):
+        backend.sync()
+
+
+class JsonSettingsBackend(SettingsBackend):
+    """Keeps all settings in memory, saved to a single JSON file.
+
+    sync() merges in changes made to the file by other processes, and
+    writes the file if needed, replacing it atomically by renaming. Like
+    QSettings, it is called by itself, sync_delay seconds after the first
+    unsaved change, and at exit.
+    """
+
+    def __init__(self, path, sync_delay=1.0):
+        super(JsonSettingsBackend, self).__init__(path)
+        self._sync_delay = sync_delay
+        self._data = {}
+        self._changes = {}
+        self._mtime = None
+        self._timer = None
+        self._load()
+
+    def _changed(self):
+        if self._timer is None:
+            self._timer = threading.Timer(self._sync_delay, self.sync)
+            self._timer.daemon = True
+            self._timer.start()
+            _unsynced[id(self)] = self
+
+    def _load(self):
+        try:
+            mtime = os.path.getmtime(self._path)
+            with open(self._path) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        self._mtime = mtime
+        self._data = data
+        for key, value in self._changes.items():
+            if value is _MISSING:
+                self._data.pop(key, None)
+            else:
+                self._data[key] = value
+
+    def _get(self, key):
+        return self._data.get(key, _MISSING)
+
+    def _set(self, key, value):
+        self._data[key] = value
+        self._changes[key] = value
+        self._changed()
+
+    def _remove(self, key):
+        for k in self._keys(key + '/' if key else ''):
+            del self._data[k]
+            self._changes[k] = _MISSING
+        if key in self._data:
+            del self._data[key]
+            self._changes[key] = _MISSING
+        self._changed()
+
+    def _keys(self, prefix):
+        return [k for k in self._data if k.startswith(prefix)]
+
+    def sync(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            _unsynced.pop(id(self), None)
+            try:
+                mtime = os.path.getmtime(self._path)
+            except OSError:
+                mtime = None
+            if mtime != self._mtime:
+                self._load()
+            if not self._changes:
+                return
+            dirname = os.path.dirname(os.path.abspath(self._path))
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            fd, tmp = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(self._data, f, indent=2, sort_keys=True)
+                _replace(tmp, self._path)
+            except:
+                os.remove(tmp)
+                raise
+            self._mtime = os.path.getmtime(self._path)
+            self._changes = {}
+
+
+class SqliteSettingsBackend(SettingsBackend):
+    """Stores settings in an SQLite database in WAL mode.
+
+    Each write is committed on its own, or with the rest of its batch (see
+    beginTransaction), without rewriting other settings, and reads see
+    writes committed by other processes. Reading doesn't block on writers.
+    Writes by other processes go to the write-ahead log, which is watched
+    along with the database, and are detected using PRAGMA data_version.
+    """
+
+    def __init__(self, path, timeout=5.0):
+        super(SqliteSettingsBackend, self).__init__(path)
+        self._db = sqlite3.connect(path, timeout=timeout,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS settings '
+                         '(key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self._depth = 0
+        self._data_version = self._get_data_version()
+
+    def _get_data_version(self):
+        return self._db.execute('PRAGMA data_version').fetchone()[0]
+
+    def beginTransaction(self):
+        super(SqliteSettingsBackend, self).beginTransaction()
+        if not self._depth:
+            self._db.execute('BEGIN')
+        self._depth += 1
+
+    def endTransaction(self):
+        try:
+            self._depth -= 1
+            if not self._depth:
+                # Operations are saved as they would be without a batch,
+                # even if it ends with an error.
+                self._db.execute('COMMIT')
+        finally:
+            super(SqliteSettingsBackend, self).endTransaction()
+
+    def watchedFiles(self):
+        return [self._path, self._path + '-wal']
+
+    def hasExternalChanges(self):
+        with self._lock:
+            version = self._get_data_version()
+            changed = version != self._data_version
+            self._data_version = version
+        return changed
+
+    def _get(self, key):
+        row = self._db.execute('SELECT value FROM settings WHERE key = ?',
+                               (key,)).fetchone()
+        return _MISSING if row is None else json.loads(row[0])
+
+    def _set(self, key, value):
+        self._db.execute(
+            'INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)',
+            (key, json.dumps(value)))
+
+    def _remove(self, key):
+        if key:
+            # Keys under key/ sort between key/ and key0, as '0' follows '/'.
+            self._db.execute('DELETE FROM settings WHERE key = ? OR '
+                             '(key > ? AND key < ?)',
+                             (key, key + '/', key + '0'))
+        else:
+            self._db.execute('DELETE FROM settings')
+
+    def _keys(self, prefix):
+        if not prefix:
+            rows = self._db.execute('SELECT key FROM settings')
+        else:
+            rows = self._db.execute(
+                'SELECT key FROM settings WHERE key >= ? AND key < ?',
+                (prefix, prefix[:-1] + '0'))
+        return [row[0] for row in rows]
+
+    def close(self):
+        self._db.close()
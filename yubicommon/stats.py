@@ -0,0 +1,72 @@
+# Copyright (c) 2013 Yubico AB
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#    1. Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    2. Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Helpers shared by the collectors of timing statistics."""
+
+from __future__ import absolute_import
+
+import json
+import time
+
+__all__ = ['timer', 'StatsCollector']
+
+
+# Monotonic, high resolution clock for measuring durations, in seconds.
+timer = getattr(time, 'perf_counter', time.time)
+
+
+class StatsCollector(object):
+    """Base class of statistics collectors, reporting to hooks and as JSON.
+
+    Subclasses implement stats(), returning a JSON serializable dict, and
+    pass each measurement to the hooks by calling _call_hooks.
+    """
+
+    def __init__(self):
+        self._hooks = []
+
+    def add_hook(self, hook):
+        """Call hook with each measurement, see the subclass for arguments.
+        """
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self._hooks.remove(hook)
+
+    def _call_hooks(self, *args):
+        for hook in self._hooks:
+            hook(*args)
+
+    def stats(self):
+        raise NotImplementedError()
+
+    def dump_json(self, fp=None):
+        """Return the statistics as JSON, also writing them to fp if given.
+        """
+        data = json.dumps(self.stats(), indent=2, sort_keys=True)
+        if fp is not None:
+            fp.write(data)
+        return data